@@ -0,0 +1,200 @@
+import math
+import time
+import atexit
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from quantize import progress_callback_stub, quantize_colors
+from mapping import palette_to_array, nearest_palette_indices, MAX_BLOCK_ELEMENTS
+from parallel import limit_threads, default_workers
+
+# Methods competing in the "Auto" mode
+AUTO_METHODS = ["Kmeans", "MMCQ", "Kmeans + MMCQ", "Median Cut", "Kmeans + Median Cut", "Popularity", "Grid Kmeans"]
+
+# Seconds given to each method, from the moment a worker starts it:
+# a method still running after that is stopped, and its worker restarted
+DEFAULT_TIME_BUDGET = 30.0
+# The progress callback is called at least this often, so that it can cancel the run
+POLL_SECONDS = 0.1
+
+# Pool of quantizer processes (kept like parallel.index_pool), used by one quantize_colors_auto at a time
+_quantizer_workers = []
+_quantizer_lock = threading.Lock()
+
+
+def palette_error(colors, counts, palette):
+    # Mean squared error per component between each pixel (the colors weighted by their
+    # pixel count) and its closest palette color, and the matching PSNR in dB
+    colors = np.asarray(colors, dtype=np.int32).reshape(-1, 3)
+    counts = np.asarray(counts, dtype=np.float64)
+    palette = palette_to_array(palette)
+    if len(colors) == 0 or len(palette) == 0:
+        return math.inf, 0.0
+
+    squared_errors = np.empty(len(colors), dtype=np.float64)
+    block_size = max(1, MAX_BLOCK_ELEMENTS // len(palette))
+    for start in range(0, len(colors), block_size):
+        block = colors[start:start + block_size]
+        differences = block - palette[nearest_palette_indices(block, palette)]
+        squared_errors[start:start + block_size] = np.einsum("ij,ij->i", differences, differences)
+
+    mse = float((squared_errors * counts).sum() / counts.sum() / 3.0)
+    psnr = math.inf if mse <= 0.0 else 10.0 * math.log10(255.0 ** 2 / mse)
+    return mse, psnr
+
+
+def run_method(colors_name, counts_name, size, n_colors, method, bits_per_gun, kmeans_options):
+    # Quantize the shared histogram with one method, returns ("ok", palette) or ("error", message)
+    colors_memory = shared_memory.SharedMemory(name=colors_name)
+    counts_memory = shared_memory.SharedMemory(name=counts_name)
+    try:
+        colors = np.ndarray((size, 3), dtype=np.int32, buffer=colors_memory.buf).copy()
+        counts = np.ndarray((size,), dtype=np.int64, buffer=counts_memory.buf).copy()
+        palette = quantize_colors(colors, n_colors, method, bits_per_gun, counts, kmeans_options)
+        return "ok", [[int(component) for component in color] for color in palette]
+    except Exception as e:
+        return "error", str(e)
+    finally:
+        colors_memory.close()
+        counts_memory.close()
+
+
+def worker_loop(connection):
+    # Worker process: run the methods it is sent until its pipe is closed.
+    # numpy and scikit-learn are imported once, when the process starts.
+    limit_threads(1)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        # the time budget starts now
+        connection.send(("started", None, 0.0))
+        start = time.perf_counter()
+        status, value = run_method(*task)
+        connection.send((status, value, time.perf_counter() - start))
+
+
+class QuantizerWorker(object):
+    """A quantizer process, and the pipe its methods are sent through."""
+    def __init__(self):
+        # spawned, for the same reason as parallel.index_pool
+        context = multiprocessing.get_context("spawn")
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=worker_loop, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.method = None
+        self.start = None  # perf_counter when the current method started
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def quantizer_workers(count):
+    # count workers of the pool, the ones that died are replaced
+    for worker in list(_quantizer_workers):
+        if not worker.process.is_alive():
+            restart_worker(worker)
+    while len(_quantizer_workers) < count:
+        _quantizer_workers.append(QuantizerWorker())
+    return _quantizer_workers[:count]
+
+
+def restart_worker(worker):
+    # stop a worker (e.g. stuck in a method past its budget), a new one takes its place
+    worker.stop()
+    replacement = QuantizerWorker()
+    _quantizer_workers[_quantizer_workers.index(worker)] = replacement
+    return replacement
+
+
+@atexit.register
+def shutdown_quantizer_pool():
+    while _quantizer_workers:
+        _quantizer_workers.pop().stop()
+
+
+def quantize_colors_auto(colors, counts, n_colors=16, bits_per_gun=4, kmeans_options=None, methods=AUTO_METHODS,
+                         time_budget=DEFAULT_TIME_BUDGET, workers=None, progress_callback=progress_callback_stub):
+    # Run the methods concurrently on the same color histogram, in a pool of workers
+    # processes, and keep the palette with the lowest error. Returns (palette, report),
+    # the report giving for each method its seconds and either its mse / psnr,
+    # or its error ("timeout" past the budget).
+    colors = np.ascontiguousarray(colors, dtype=np.int32).reshape(-1, 3)
+    counts = np.ascontiguousarray(counts if counts is not None else np.ones(len(colors)), dtype=np.int64)
+    workers = min(workers or default_workers(), len(methods))
+
+    with _quantizer_lock:
+        colors_memory = shared_memory.SharedMemory(create=True, size=max(1, colors.nbytes))
+        counts_memory = shared_memory.SharedMemory(create=True, size=max(1, counts.nbytes))
+        np.ndarray(colors.shape, dtype=np.int32, buffer=colors_memory.buf)[:] = colors
+        np.ndarray(counts.shape, dtype=np.int64, buffer=counts_memory.buf)[:] = counts
+
+        report = {}
+        palettes = {}
+        waiting = list(methods)
+        busy = {}  # connection -> worker
+        try:
+            idle = list(quantizer_workers(workers))
+            while waiting or busy:
+                while waiting and idle:
+                    worker = idle.pop(0)
+                    worker.method, worker.start = waiting.pop(0), None
+                    worker.connection.send((colors_memory.name, counts_memory.name, len(colors),
+                                            n_colors, worker.method, bits_per_gun, kmeans_options))
+                    busy[worker.connection] = worker
+
+                # wait for a result, or for the closest deadline
+                now = time.perf_counter()
+                deadlines = [worker.start + time_budget for worker in busy.values() if worker.start is not None]
+                timeout = min([POLL_SECONDS] + [max(0.0, deadline - now) for deadline in deadlines])
+                progress_callback(len(report) / len(methods))
+                for connection in wait(list(busy), timeout):
+                    worker = busy[connection]
+                    try:
+                        status, value, seconds = connection.recv()
+                    except EOFError:
+                        status, value, seconds = "error", "worker exited", 0.0
+                    if status == "started":
+                        worker.start = time.perf_counter()
+                        continue
+
+                    del busy[connection]
+                    report[worker.method] = {"seconds": seconds}
+                    if status == "ok":
+                        palettes[worker.method] = value
+                        report[worker.method]["mse"], report[worker.method]["psnr"] = palette_error(colors, counts, value)
+                    else:
+                        report[worker.method]["error"] = value
+                    idle.append(worker if worker.process.is_alive() else restart_worker(worker))
+
+                now = time.perf_counter()
+                for connection, worker in list(busy.items()):
+                    if worker.start is not None and now - worker.start >= time_budget:
+                        del busy[connection]
+                        report[worker.method] = {"seconds": now - worker.start, "error": "timeout"}
+                        idle.append(restart_worker(worker))
+        finally:
+            # e.g. a cancelled conversion: the methods still running are stopped
+            for worker in busy.values():
+                restart_worker(worker)
+            colors_memory.close()
+            colors_memory.unlink()
+            counts_memory.close()
+            counts_memory.unlink()
+    progress_callback(1.0)
+
+    if not palettes:
+        raise ValueError("No quantization method succeeded: " + str(report))
+
+    # lowest error wins, the first method of the list on ties
+    winner = min(palettes, key=lambda method: (report[method]["mse"], methods.index(method)))
+    report[winner]["winner"] = True
+    return palettes[winner], report
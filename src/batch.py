@@ -1,14 +1,159 @@
 import os
+import sys
+import time
+import fnmatch
 import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from raw import export_image_to_raw, load_raw_image
+from manifest import BuildManifest, MANIFEST_VERSION
+from pipeline import ConversionPipeline, PipelineConfig
+from quantize import pack_colors, unpack_colors, accumulate_key_counts
+from dither import DITHER_PATTERNS, ERROR_DIFFUSION_METHODS
+from mapping import LOOKUP_MODES
+from colorspace import COLOR_SPACES
+from palette_cache import open_palette_cache, default_cache_dir
+from instrument import Tracer
+from parallel import limit_threads, default_workers
+from auto import AUTO_METHODS, DEFAULT_TIME_BUDGET
 
-export_in = "/Users/fra/dev/game-amiga-muses/artwork/muse-wip/vues/export-in/"
-export_out = "/Users/fra/dev/game-amiga-muses/artwork/muse-wip/vues/export-out/"
-export_debug = "/Users/fra/dev/game-amiga-muses/artwork/muse-wip/vues/export-debug/"
+QUANTIZE_METHODS = AUTO_METHODS + ["Auto"]
 
+def run_jobs(function, arguments, jobs=1, threads_per_job=None):
+    # Call function on each tuple of arguments, in a pool of jobs worker processes,
+    # and yield the results as they come
+    if jobs <= 1 or len(arguments) <= 1:
+        if threads_per_job is not None:
+            limit_threads(threads_per_job)
+        for args in arguments:
+            yield function(*args)
+        return
 
-def convert_all_png_to_raw(source_dir, dest_dir, debug_dir=None, log_file='conversion.log'):
+    # share the cores between the workers,
+    # which inherit the thread limits through their environment
+    if threads_per_job is None:
+        threads_per_job = max(1, (os.cpu_count() or 1) // jobs)
+    limit_threads(threads_per_job)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=limit_threads, initargs=(threads_per_job,)) as executor:
+        futures = [executor.submit(function, *args) for args in arguments]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def find_source_files(source_dir, patterns=("*.png",), recursive=False):
+    # returns the matching paths, relative to source_dir, in a stable order
+    found = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if any(fnmatch.fnmatch(filename.lower(), pattern.lower()) for pattern in patterns):
+                found.append(os.path.relpath(os.path.join(root, filename), source_dir))
+        if not recursive:
+            break
+    return found
+
+
+def conversion_parameters(dest_dir, debug_dir=None, config=None, palette=None):
+    # Everything besides the source content that changes the outputs,
+    # a change of parameters triggers a new conversion.
+    # The debug directory is relative to dest_dir, like the outputs of the manifest.
+    debug = os.path.relpath(debug_dir, dest_dir) if debug_dir is not None else None
+    return {"format": "SAFB", "manifest": MANIFEST_VERSION, "debug": debug,
+            "pipeline": config.to_dict() if config is not None else None,
+            "palette": palette}
+
+
+def conversion_pipeline(config, cache_dir=None, tracer=None, index_workers=1):
+    # the palette cache is opened once per worker process
+    return ConversionPipeline(config, open_palette_cache(cache_dir) if cache_dir is not None else None, tracer, index_workers)
+
+
+def image_color_histogram(source_dir, relative_path):
+    # Distinct colors of a true color image and their pixel count, None for indexed images
+    try:
+        image = Image.open(os.path.join(source_dir, relative_path))
+        if image.mode == "P":
+            return relative_path, None, None
+        return relative_path, ConversionPipeline().extract_colors(image), None
+    except Exception as e:
+        return relative_path, None, f"Error reading colors of {relative_path}: {e}"
+
+
+def build_shared_palette(source_dir, sources, config, jobs=1, threads_per_job=None, cache_dir=None, tracer=None):
+    # One palette for the whole image set: the color histograms of the images are
+    # computed in parallel and merged as they come, so that memory depends on the
+    # number of distinct colors rather than on the total number of pixels.
+    def image_histograms():
+        for relative_path, image_histogram, error in run_jobs(image_color_histogram, [(source_dir, relative_path) for relative_path in sources], jobs, threads_per_job):
+            if error is not None:
+                logging.error(error)
+                print(f"{relative_path}: FAILED ({error})")
+            elif image_histogram is not None:
+                colors, counts = image_histogram
+                yield pack_colors(colors), counts
+
+    histogram = accumulate_key_counts(image_histograms())
+    if histogram is None:
+        return None
+    # the "Auto" quantization of the single palette may use all the cores
+    pipeline = conversion_pipeline(config, cache_dir, tracer, default_workers())
+    keys, counts = histogram
+    colors = unpack_colors(keys)
+    print(f"Shared palette: {len(colors)} distinct colors in {len(sources)} images")
+    return pipeline.sort_palette(pipeline.quantize(colors, counts))
+
+
+def convert_png_to_raw(source_dir, relative_path, dest_dir, debug_dir=None, config=None, palette=None, cache_dir=None, trace=False,
+                       strip_height=None, index_workers=1):
+    # Indexed images are exported as they are, true color images first go
+    # through the conversion pipeline (quantization, dither, indexing) set by config,
+    # using the given palette if any, or the palette cache in cache_dir.
+    # With a strip_height, true color images are converted and written by strips of rows.
+    # Convert a single image, returns (relative_path, seconds, pixel count, error message, output files, trace events)
+    start = time.perf_counter()
+    img_path = os.path.join(source_dir, relative_path)
+    raw_path = os.path.join(dest_dir, os.path.splitext(relative_path)[0] + ".raw")
+    tracer = Tracer(enabled=trace, image=relative_path)
+
+    # Load the image using PIL
+    try:
+        with tracer.stage("load") as counts:
+            image = Image.open(img_path)
+            image.load()
+            counts["pixels"] = image.width * image.height
+    except Exception as e:
+        return relative_path, time.perf_counter() - start, 0, f"Error opening image {img_path}: {e}", [], tracer.events
+
+    # Convert the image to RAW format
+    outputs = [raw_path]
+    try:
+        os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+        if image.mode != "P" and config is None:
+            raise ValueError(f"{image.mode} image, a conversion pipeline is required")
+        if image.mode != "P" and strip_height:
+            conversion_pipeline(config, cache_dir, tracer).run_streaming(image, raw_path, palette=palette, strip_height=strip_height)
+            debug_image = load_raw_image(raw_path) if debug_dir is not None else None
+        else:
+            if image.mode != "P":
+                image, _ = conversion_pipeline(config, cache_dir, tracer, index_workers).run(image, palette=palette)
+            with tracer.stage("export", pixels=image.width * image.height):
+                debug_image = export_image_to_raw(image, raw_path)
+        if debug_dir is not None:
+            debug_path = os.path.join(debug_dir, relative_path)
+            os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+            debug_image.save(debug_path)
+            outputs.append(debug_path)
+    except Exception as e:
+        return relative_path, time.perf_counter() - start, 0, f"Error converting {img_path} to {raw_path}: {e}", [], tracer.events
+
+    return relative_path, time.perf_counter() - start, image.width * image.height, None, outputs, tracer.events
+
+
+def convert_all_png_to_raw(source_dir, dest_dir, debug_dir=None, log_file='conversion.log',
+                           patterns=("*.png",), recursive=False, jobs=1, threads_per_job=None, force=False,
+                           config=None, shared_palette=False, cache_dir=None, trace_file=None, strip_height=None,
+                           index_workers=None):
     # Set up logging
     logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s %(message)s')
 
@@ -17,28 +162,122 @@ def convert_all_png_to_raw(source_dir, dest_dir, debug_dir=None, log_file='conve
         os.makedirs(dest_dir)
         logging.info(f"Created destination directory: {dest_dir}")
 
-    # Iterate through all files in the source directory
-    for filename in os.listdir(source_dir):
-        if filename.endswith(".png"):
-            # Load the image using PIL
-            img_path = os.path.join(source_dir, filename)
-            try:
-                image = Image.open(img_path)
-            except Exception as e:
-                logging.error(f"Error opening image {img_path}: {e}")
-                continue
-
-            # Convert the image to RAW format
-            raw_filename = filename.replace(".png", ".raw")
-            raw_path = os.path.join(dest_dir, raw_filename)
-            try:
-                debug_image = export_image_to_raw(image, raw_path)
-                if debug_dir is not None:
-                    debug_path = os.path.join(debug_dir, filename)
-                    debug_image.save(debug_path)
-                logging.info(f"Successfully converted {img_path} to {raw_path}")
+    sources = find_source_files(source_dir, patterns, recursive)
+    results = []
+    start = time.perf_counter()
+
+    # per stage timings, written to trace_file (see instrument.Tracer.write)
+    tracer = Tracer(enabled=trace_file is not None)
+
+    palette = None
+    if shared_palette and config is not None:
+        palette = build_shared_palette(source_dir, sources, config, jobs, threads_per_job, cache_dir, tracer)
+
+    # Only the new or modified sources (or those converted with other parameters) are converted again
+    manifest = BuildManifest(dest_dir).load()
+    params = conversion_parameters(dest_dir, debug_dir, config, palette)
+    source_states = {}
+    stale_sources = []
+    for relative_path in sources:
+        source_states[relative_path] = manifest.source_hash(source_dir, relative_path)
+        if force or not manifest.is_up_to_date(relative_path, source_states[relative_path][0], params):
+            stale_sources.append(relative_path)
+    skipped = len(sources) - len(stale_sources)
+
+    for path in manifest.remove_orphans(sources):
+        logging.info(f"Removed orphaned output {path}")
+        print(f"{path}: removed")
+
+    def report(result):
+        relative_path, seconds, pixels, error, outputs, events = result
+        results.append(result)
+        tracer.extend(events)
+        if error is None:
+            source_hash, stat = source_states[relative_path]
+            manifest.record(relative_path, source_hash, stat, params, outputs)
+            logging.info(f"Successfully converted {relative_path} in {seconds:.3f}s")
+            print(f"{relative_path}: {seconds * 1000:.1f} ms")
+        else:
+            manifest.forget(relative_path)
+            logging.error(error)
+            print(f"{relative_path}: FAILED ({error})")
+
+    try:
+        # When the images are converted one at a time, each of them is indexed on all the cores
+        if index_workers is None:
+            index_workers = default_workers() if jobs <= 1 or len(stale_sources) <= 1 else 1
+        arguments = [(source_dir, relative_path, dest_dir, debug_dir, config, palette, cache_dir, tracer.enabled, strip_height, index_workers)
+                     for relative_path in stale_sources]
+        for result in run_jobs(convert_png_to_raw, arguments, jobs, threads_per_job):
+            report(result)
+    finally:
+        # keep track of the work done, even if interrupted
+        manifest.save()
+        if trace_file is not None:
+            tracer.write(trace_file)
+
+    elapsed = time.perf_counter() - start
+    print_summary(results, elapsed, jobs, skipped)
+    return results
+
+
+def print_summary(results, elapsed, jobs, skipped=0):
+    converted = [result for result in results if result[3] is None]
+    failed = len(results) - len(converted)
+    busy = sum(result[1] for result in results)
+    pixels = sum(result[2] for result in results)
+
+    summary = (f"{len(converted)} converted, {failed} failed, {skipped} up to date in {elapsed:.2f}s "
+               f"({len(converted) / elapsed if elapsed else 0.0:.1f} files/s, "
+               f"{pixels / 1e6 / elapsed if elapsed else 0.0:.2f} Mpixels/s, "
+               f"{busy:.2f}s of conversion on {jobs} job(s))")
+    logging.info(summary)
+    print(summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert PNG images to SAFB (.raw) files. Indexed images are exported as they are, "
+                                                 "true color images are quantized, dithered and indexed first.")
+    parser.add_argument("input", help="source directory")
+    parser.add_argument("output", help="destination directory of the .raw files")
+    parser.add_argument("--debug", metavar="DIR", default=None, help="also save the reloaded .raw files as PNG in this directory")
+    parser.add_argument("--pattern", action="append", default=None, help="file name pattern to convert, can be repeated (default: *.png)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="look for images in sub-directories too")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: one per core)")
+    parser.add_argument("--index-workers", type=int, default=None, help="processes indexing each large image (default: all the cores when the images are converted one at a time)")
+    parser.add_argument("--threads-per-job", type=int, default=None, help="BLAS/OpenMP threads allowed in each worker (default: cores / jobs)")
+    parser.add_argument("--log", default="conversion.log", help="log file (default: conversion.log)")
+    parser.add_argument("--force", action="store_true", help="convert every image, even the ones that are up to date")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="write the time spent in each conversion stage, as a Chrome trace (.json) or JSON lines (.jsonl)")
+    pipeline_group = parser.add_argument_group("true color images")
+    pipeline_group.add_argument("--colors", type=int, default=16, help="palette size (default: 16)")
+    pipeline_group.add_argument("--method", choices=QUANTIZE_METHODS, default="Kmeans", help="quantization method (default: Kmeans)")
+    pipeline_group.add_argument("--bits", type=int, default=4, help="bits per color component of the palette (default: 4)")
+    pipeline_group.add_argument("--dither", type=float, default=0.05, help="dither intensity, 0 to disable (default: 0.05)")
+    pipeline_group.add_argument("--dither-pattern", choices=DITHER_PATTERNS + ERROR_DIFFUSION_METHODS, default="Checkerboard", help="dither pattern (default: Checkerboard)")
+    pipeline_group.add_argument("--lookup", choices=LOOKUP_MODES, default="exact", help="palette lookup (default: exact)")
+    pipeline_group.add_argument("--color-space", choices=COLOR_SPACES, default="RGB", help="space of the color distances, for the KMeans and the palette lookup (default: RGB)")
+    pipeline_group.add_argument("--kmeans-sample-budget", type=int, default=None, help="cluster a weighted subsample of at most this many colors (default: all colors)")
+    pipeline_group.add_argument("--kmeans-minibatch", action="store_true", help="use mini-batch KMeans")
+    pipeline_group.add_argument("--auto-time-budget", type=float, default=DEFAULT_TIME_BUDGET, help="seconds given to each method tried by --method Auto (default: %(default)s)")
+    pipeline_group.add_argument("--shared-palette", action="store_true", help="compute a single palette for all the images")
+    pipeline_group.add_argument("--strip-height", type=int, default=None, help="convert by strips of this many rows, to bound the memory used by very large images (ordered dither only)")
+    pipeline_group.add_argument("--cache-dir", default=default_cache_dir(), help="palette cache directory, can be shared between machines (default: %(default)s)")
+    pipeline_group.add_argument("--no-cache", action="store_true", help="always compute the palettes")
+    args = parser.parse_args(argv)
+    if args.strip_height and args.dither > 0.0 and args.dither_pattern in ERROR_DIFFUSION_METHODS:
+        parser.error("--strip-height only supports the ordered dither patterns")
+
+    config = PipelineConfig(args.colors, args.method, args.bits, args.dither, args.dither_pattern, args.lookup,
+                            args.kmeans_sample_budget, args.kmeans_minibatch, args.auto_time_budget,
+                            args.color_space)
+
+    results = convert_all_png_to_raw(args.input, args.output, args.debug, args.log,
+                                     args.pattern or ["*.png"], args.recursive, args.jobs, args.threads_per_job,
+                                     args.force, config, args.shared_palette,
+                                     None if args.no_cache else args.cache_dir, args.trace, args.strip_height, args.index_workers)
+    return 0 if all(result[3] is None for result in results) else 1
 
-            except Exception as e:
-                logging.error(f"Error converting {img_path} to {raw_path}: {e}")
 
-convert_all_png_to_raw(export_in, export_out, export_debug)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import platform
+import signal
+import argparse
+import statistics
+import tempfile
+import contextlib
+
+import numpy as np
+from PIL import Image
+
+from quantize import build_color_histogram_from_image, quantize_colors, png_24bit_to_indexed, apply_dither_overlay
+from mmcq import MMCQ
+from raw import export_image_to_raw, load_raw_image
+from batch import find_source_files
+from auto import AUTO_METHODS
+
+BENCHMARK_VERSION = 1
+
+# Synthetic corpus, from the Atari ST low resolution up to 4K
+IMAGE_SIZES = [(320, 200), (640, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+QUICK_IMAGE_SIZES = [(320, 200), (640, 480)]
+IMAGE_KINDS = ["photo", "flat"]
+CORPUS_SEED = 1234
+
+# Ordered dither patterns measured (see dither.DITHER_PATTERNS)
+BENCHMARK_DITHER_PATTERNS = ["Checkerboard", "Bayer 4x4", "Blue noise"]
+
+# Perceptual color spaces of the palette lookup (see colorspace.COLOR_SPACES)
+BENCHMARK_COLOR_SPACES = ["OKLab", "CIELAB"]
+
+# A run slower than the reference by more than this ratio is a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Seconds allowed to all the runs of a case, a slower case is recorded as failed
+CASE_TIMEOUT = 300
+
+
+class CaseTimeout(Exception):
+    """Raised in a benchmark case that runs past its time limit."""
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    # SIGALRM based, only available on Unix and in the main thread: elsewhere the case is not limited
+    if not seconds or not hasattr(signal, "SIGALRM"):
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise CaseTimeout(f"longer than {seconds} s")
+
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def photo_image(width, height, seed=CORPUS_SEED):
+    # Smooth gradients, soft blobs and sensor like noise: many distinct colors
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x /= width
+    y /= height
+    img = np.empty((height, width, 3), dtype=np.float32)
+    for c in range(3):
+        fx, fy, phase = rng.uniform(0.5, 3.0), rng.uniform(0.5, 3.0), rng.uniform(0, 2 * np.pi)
+        img[:, :, c] = 128 + 80 * np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+    for _ in range(12):
+        cx, cy, radius = rng.uniform(0, 1), rng.uniform(0, 1), rng.uniform(0.05, 0.3)
+        blob = np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius ** 2))
+        img += blob[:, :, None] * rng.uniform(-90, 90, 3).astype(np.float32)
+    img += rng.normal(0, 6, img.shape).astype(np.float32)
+    return Image.fromarray(img.clip(0, 255).astype(np.uint8))
+
+
+def flat_image(width, height, seed=CORPUS_SEED):
+    # Pixel art like: a few flat colors in rectangles and disks
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, (12, 3), dtype=np.uint8)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = colors[0]
+    y, x = np.ogrid[0:height, 0:width]
+    for _ in range(40):
+        color = colors[rng.integers(1, len(colors))]
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        size = rng.integers(min(width, height) // 20, min(width, height) // 4)
+        if rng.random() < 0.5:
+            img[y0:y0 + size, x0:x0 + size] = color
+        else:
+            img[(x - x0) ** 2 + (y - y0) ** 2 <= size ** 2] = color
+    return Image.fromarray(img)
+
+
+def synthetic_corpus(sizes=IMAGE_SIZES, kinds=IMAGE_KINDS):
+    # [(name, image)], the same images on every run
+    generators = {"photo": photo_image, "flat": flat_image}
+    return [(f"{kind}-{width}x{height}", generators[kind](width, height)) for kind in kinds for width, height in sizes]
+
+
+def sample_corpus(images_dir):
+    corpus = []
+    for relative_path in find_source_files(images_dir, ("*.png",), recursive=True):
+        image = Image.open(os.path.join(images_dir, relative_path)).convert("RGB")
+        corpus.append((relative_path, image))
+    return corpus
+
+
+def time_function(function, repeat):
+    # wall times of repeat calls, the output of the benchmarked code is silenced
+    runs = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            runs.append(time.perf_counter() - start)
+    return runs
+
+
+def benchmark_cases(name, image, methods, palette_size, work_dir):
+    # (case name, function) of each measured hot path on one image
+    colors, counts = build_color_histogram_from_image(image)
+    # the grid quantizer also copes with images that have fewer colors than the palette
+    reference_palette = quantize_colors(colors, palette_size, "grid kmeans", 4, counts)
+    raw_path = os.path.join(work_dir, "benchmark.raw")
+    indexed = png_24bit_to_indexed(image, reference_palette)
+
+    cases = [("extract colors/" + name, lambda: build_color_histogram_from_image(image))]
+    for method in methods:
+        cases.append((f"quantize {method}/{name}", lambda method=method: quantize_colors(colors, palette_size, method, 4, counts)))
+    cases.append(("MMCQ.quantize/" + name, lambda: MMCQ.quantize([tuple(color) for color in colors.tolist()], palette_size, counts)))
+    for lookup in ["exact", "binned"]:
+        cases.append((f"png_24bit_to_indexed {lookup}/{name}", lambda lookup=lookup: png_24bit_to_indexed(image, reference_palette, lookup=lookup)))
+    for color_space in BENCHMARK_COLOR_SPACES:
+        cases.append((f"png_24bit_to_indexed exact {color_space}/{name}",
+                      lambda color_space=color_space: png_24bit_to_indexed(image, reference_palette, color_space=color_space)))
+    for pattern in BENCHMARK_DITHER_PATTERNS:
+        cases.append((f"apply_dither_overlay {pattern}/{name}", lambda pattern=pattern: apply_dither_overlay(image, 0.05, pattern=pattern)))
+    cases.append(("export_image_to_raw/" + name, lambda: export_image_to_raw(indexed, raw_path)))
+    cases.append(("load_raw_image/" + name, lambda: load_raw_image(raw_path)))
+    return cases, image.width * image.height
+
+
+def run_benchmarks(corpus, methods=AUTO_METHODS, palette_size=16, repeat=3, selection=None, case_timeout=CASE_TIMEOUT):
+    # selection: only run the cases whose name contains one of these strings
+    # case_timeout: seconds allowed to the runs of each case, so that a stuck case cannot stall the suite
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, image in corpus:
+            cases, pixels = benchmark_cases(name, image, methods, palette_size, work_dir)
+            for case, function in cases:
+                if selection and not any(part.lower() in case.lower() for part in selection):
+                    continue
+                try:
+                    with time_limit(case_timeout):
+                        runs = time_function(function, repeat)
+                except Exception as e:
+                    # e.g. a quantizer that cannot find enough colors in a flat image, or a timeout
+                    results[case] = {"error": str(e), "pixels": pixels}
+                    print(f"{case}: FAILED ({e})")
+                    continue
+                results[case] = {"min": min(runs), "median": statistics.median(runs), "runs": runs, "pixels": pixels}
+                print(f"{case}: {min(runs) * 1000:.1f} ms")
+    return results
+
+
+def environment():
+    import sklearn
+    return {"python": platform.python_version(), "numpy": np.__version__, "scikit-learn": sklearn.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+
+def save_results(results, filename, repeat):
+    with open(filename, "w") as file:
+        json.dump({"version": BENCHMARK_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "environment": environment(), "repeat": repeat, "results": results},
+                  file, indent=1, sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename, "r") as file:
+        content = json.load(file)
+    if content.get("version") != BENCHMARK_VERSION:
+        raise ValueError(f"{filename}: unsupported benchmark version {content.get('version')}")
+    return content["results"]
+
+
+def compare_results(reference, current, threshold=REGRESSION_THRESHOLD):
+    # Compare the best times of two runs, returns the regressed cases
+    regressions = []
+    for case in sorted(set(reference) | set(current)):
+        if case not in current or case not in reference:
+            print(f"{case}: only in the {'reference' if case in reference else 'current'} run")
+            continue
+        if "error" in reference[case] or "error" in current[case]:
+            if "error" in current[case] and "error" not in reference[case]:
+                regressions.append(case)
+                print(f"{case}: REGRESSION ({current[case]['error']})")
+            continue
+        before, after = reference[case]["min"], current[case]["min"]
+        ratio = after / before if before > 0 else float("inf")
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(case)
+        elif ratio < 1 - threshold:
+            status = "faster"
+        else:
+            status = "same"
+        print(f"{case}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms ({ratio:.2f}x) {status}")
+    print(f"{len(regressions)} regression(s) over {threshold * 100:.0f}%")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the quantizers, the palette mapping, the dither overlay and the SAFB I/O.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and save the results")
+    run_parser.add_argument("-o", "--output", default="benchmark.json", help="results file (default: benchmark.json)")
+    run_parser.add_argument("--quick", action="store_true", help="only the small images")
+    run_parser.add_argument("--images", metavar="DIR", default=None, help="also benchmark the PNG images of this directory")
+    run_parser.add_argument("--method", action="append", choices=AUTO_METHODS, default=None, help="quantization method, can be repeated (default: all)")
+    run_parser.add_argument("--select", action="append", default=None, help="only run the cases whose name contains this text, can be repeated")
+    run_parser.add_argument("--colors", type=int, default=16, help="palette size (default: 16)")
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the best one is compared (default: 3)")
+    run_parser.add_argument("--case-timeout", type=float, default=CASE_TIMEOUT,
+                            help="seconds allowed to the runs of each case, 0 for no limit (default: %(default)s)")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("reference", help="results of the reference run")
+    compare_parser.add_argument("current", help="results of the new run")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                                help="slowdown ratio reported as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        regressions = compare_results(load_results(args.reference), load_results(args.current), args.threshold)
+        return 1 if regressions else 0
+
+    corpus = synthetic_corpus(QUICK_IMAGE_SIZES if args.quick else IMAGE_SIZES)
+    if args.images is not None:
+        corpus += sample_corpus(args.images)
+    results = run_benchmarks(corpus, args.method or AUTO_METHODS, args.colors, args.repeat, args.select, args.case_timeout)
+    save_results(results, args.output, args.repeat)
+    print(f"{len(results)} cases saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
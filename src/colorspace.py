@@ -0,0 +1,134 @@
+import numpy as np
+
+# Color spaces in which the color distances can be measured
+# "RGB": plain euclidean distance between the 8 bits components
+# "OKLab", "CIELAB" (D65): perceptual spaces, equal distances look about equally different
+COLOR_SPACES = ["RGB", "OKLab", "CIELAB"]
+
+# Colors converted to a perceptual space go through:
+#   8 bits component -> linear light (table of 256 entries, the same for the 3 channels)
+#   -> first matrix -> non linear response (cube root) -> second matrix + offset
+OKLAB_LMS = np.array([[0.4122214708, 0.5363325363, 0.0514459929],
+                      [0.2119034982, 0.6806995451, 0.1073969566],
+                      [0.0883024619, 0.2817188376, 0.6299787005]])
+OKLAB_LAB = np.array([[0.2104542553, 0.7936177850, -0.0040720468],
+                      [1.9779984951, -2.4285922050, 0.4505937099],
+                      [0.0259040371, 0.7827717662, -0.8086757660]])
+
+# sRGB -> XYZ, each row divided by the D65 white point
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+CIELAB_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                       [0.2126729, 0.7151522, 0.0721750],
+                       [0.0193339, 0.1191920, 0.9503041]]) / D65_WHITE[:, None]
+CIELAB_LAB = np.array([[0.0, 116.0, 0.0],
+                       [500.0, -500.0, 0.0],
+                       [0.0, 200.0, -200.0]])
+CIELAB_OFFSET = np.array([-16.0, 0.0, 0.0])
+CIELAB_EPSILON = (6.0 / 29.0) ** 3
+
+# Converted grid colors, e.g. the 4096 colors of RGB444
+_grid_tables = {}
+
+
+def is_rgb(color_space):
+    return color_space is None or color_space.lower() == "rgb"
+
+
+def srgb_to_linear(values):
+    # values: 0.0 - 1.0 sRGB components
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(values):
+    values = np.clip(values, 0.0, 1.0)
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+
+
+def cielab_f(t):
+    return np.where(t > CIELAB_EPSILON, np.cbrt(t), t / (3 * (6.0 / 29.0) ** 2) + 4.0 / 29.0)
+
+
+def cielab_f_inverse(t):
+    return np.where(t > 6.0 / 29.0, t ** 3, 3 * (6.0 / 29.0) ** 2 * (t - 4.0 / 29.0))
+
+
+class ColorSpace(object):
+    """Conversion of 8 bits sRGB colors to a perceptual color space."""
+    def __init__(self, name, first_matrix, response, inverse_response, second_matrix, offset=(0.0, 0.0, 0.0)):
+        self.name = name
+        self.first_matrix = first_matrix
+        self.response = response
+        self.inverse_response = inverse_response
+        self.second_matrix = second_matrix
+        self.offset = np.asarray(offset)
+        # the sRGB transfer function is a table lookup rather than a power per component,
+        # the rest is two 3x3 matrix products (BLAS) and a cube root
+        self.linear_table = srgb_to_linear(np.arange(256) / 255.0).astype(np.float32)
+        self.first_matrix_t = first_matrix.T.astype(np.float32)
+        self.second_matrix_t = second_matrix.T.astype(np.float32)
+        self.offset_32 = self.offset.astype(np.float32)
+
+    def from_rgb(self, colors):
+        # (N, 3) 8 bits colors -> (N, 3) float32 coordinates
+        colors = np.asarray(colors).reshape(-1, 3)
+        if colors.dtype != np.uint8:
+            colors = colors.astype(np.intp)
+        mixed = np.take(self.linear_table, colors) @ self.first_matrix_t
+        converted = self.response(mixed).astype(np.float32, copy=False) @ self.second_matrix_t
+        converted += self.offset_32
+        return converted
+
+    def to_rgb(self, values):
+        # (N, 3) coordinates -> (N, 3) float 0.0 - 255.0 sRGB colors, out of gamut colors are clipped
+        values = np.asarray(values, dtype=np.float64).reshape(-1, 3)
+        mixed = self.inverse_response((values - self.offset) @ np.linalg.inv(self.second_matrix).T)
+        linear = mixed @ np.linalg.inv(self.first_matrix).T
+        return linear_to_srgb(linear) * 255.0
+
+
+COLOR_SPACE_CONVERSIONS = {
+    "oklab": ColorSpace("OKLab", OKLAB_LMS, np.cbrt, lambda t: t ** 3, OKLAB_LAB),
+    "cielab": ColorSpace("CIELAB", CIELAB_XYZ, cielab_f, cielab_f_inverse, CIELAB_LAB, CIELAB_OFFSET),
+}
+
+
+def color_space_conversion(color_space):
+    try:
+        return COLOR_SPACE_CONVERSIONS[color_space.lower()]
+    except KeyError:
+        raise ValueError("Unknown color space: " + str(color_space))
+
+
+def to_color_space(colors, color_space="RGB"):
+    # (N, 3) 8 bits colors -> (N, 3) float32 coordinates in which distances are measured
+    if is_rgb(color_space):
+        return np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+    return color_space_conversion(color_space).from_rgb(colors)
+
+
+def from_color_space(values, color_space="RGB"):
+    # (N, 3) coordinates -> (N, 3) float 0.0 - 255.0 colors
+    if is_rgb(color_space):
+        return np.clip(np.asarray(values, dtype=np.float64).reshape(-1, 3), 0.0, 255.0)
+    return color_space_conversion(color_space).to_rgb(values)
+
+
+def grid_colors(bits_per_gun=4):
+    # The colors of the reduced color space, in cell order (see mapping.pixels_to_cells).
+    # Each component is spread over the full 0-255 range (0x0 -> 0, 0xF -> 255 in RGB444).
+    levels = 1 << bits_per_gun
+    shades = np.round(np.arange(levels) * 255.0 / (levels - 1)).astype(np.int32)
+    r, g, b = np.meshgrid(shades, shades, shades, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+
+def grid_color_table(bits_per_gun=4, color_space="RGB"):
+    # grid_colors converted to color_space, computed once (4096 entries for RGB444)
+    key = (bits_per_gun, color_space.lower())
+    table = _grid_tables.get(key)
+    if table is None:
+        table = to_color_space(grid_colors(bits_per_gun), color_space)
+        table.flags.writeable = False
+        _grid_tables[key] = table
+    return table
@@ -0,0 +1,276 @@
+from functools import lru_cache
+
+import numpy as np
+
+from mapping import palette_to_array, duplicate_palette_remap, get_inverse_palette, MAX_BLOCK_ELEMENTS
+
+
+# Dither patterns, all of them tiled over the image
+DITHER_PATTERNS = ["Checkerboard", "Bayer 2x2", "Bayer 4x4", "Bayer 8x8", "Blue noise"]
+
+BLUE_NOISE_SIZE = 64
+
+# Error diffusion methods, the palette index is chosen while the error is spread
+ERROR_DIFFUSION_METHODS = ["Floyd-Steinberg", "Atkinson", "Sierra lite"]
+
+# (dx, dy, weight) of each neighbour receiving a share of the error,
+# for a left to right sweep (dx is mirrored on right to left rows)
+ERROR_DIFFUSION_KERNELS = {
+    "floyd-steinberg": [(1, 0, 7 / 16), (-1, 1, 3 / 16), (0, 1, 5 / 16), (1, 1, 1 / 16)],
+    "atkinson": [(1, 0, 1 / 8), (2, 0, 1 / 8), (-1, 1, 1 / 8), (0, 1, 1 / 8), (1, 1, 1 / 8), (0, 2, 1 / 8)],
+    "sierra lite": [(1, 0, 2 / 4), (-1, 1, 1 / 4), (0, 1, 1 / 4)],
+}
+
+# The exact error diffusion lookup only compares a pixel with the palette colors
+# that can be the closest in its cell of the color space. The cells are as fine as
+# the (cells x palette entries) table of candidates allows, e.g. 5 bits per component
+# for 16 colors, 4 bits for 256 colors.
+CANDIDATE_TABLE_ELEMENTS = 1 << 21
+MAX_CANDIDATE_CELL_BITS = 6
+
+
+def bayer_matrix(size):
+    # Recursive Bayer index matrix, size being a power of 2
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def blue_noise_matrix(size=BLUE_NOISE_SIZE, sigma=1.5, seed=0):
+    # Void-and-cluster rank matrix (Ulichney), computed on a torus
+    # so that it tiles without seams.
+    rng = np.random.default_rng(seed)
+    n = size * size
+
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(distance[:, None] ** 2 + distance[None, :] ** 2) / (2.0 * sigma ** 2))
+
+    def splat(energy, index, sign):
+        y, x = divmod(int(index), size)
+        energy += sign * np.roll(np.roll(kernel, y, axis=0), x, axis=1)
+
+    def energy_of(pattern):
+        return np.real(np.fft.ifft2(np.fft.fft2(pattern) * np.fft.fft2(kernel)))
+
+    # Initial pattern, then move points from the tightest cluster
+    # to the largest void until it is evenly spread
+    pattern = rng.random((size, size)) < 0.1
+    energy = energy_of(pattern)
+    while True:
+        cluster = np.argmax(np.where(pattern, energy, -np.inf))
+        pattern.flat[cluster] = False
+        splat(energy, cluster, -1.0)
+        void = np.argmin(np.where(pattern, np.inf, energy))
+        pattern.flat[void] = True
+        splat(energy, void, 1.0)
+        if void == cluster:
+            break
+
+    ranks = np.zeros(n, dtype=np.int32)
+    ones = int(pattern.sum())
+
+    # Ranks below the initial pattern: remove the tightest clusters first
+    removing = pattern.copy()
+    removing_energy = energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = np.argmax(np.where(removing, removing_energy, -np.inf))
+        removing.flat[cluster] = False
+        splat(removing_energy, cluster, -1.0)
+        ranks[cluster] = rank
+
+    # Ranks above: fill the largest voids first
+    for rank in range(ones, n):
+        void = np.argmin(np.where(pattern, np.inf, energy))
+        pattern.flat[void] = True
+        splat(energy, void, 1.0)
+        ranks[void] = rank
+
+    return ranks.reshape(size, size)
+
+
+@lru_cache(maxsize=None)
+def threshold_map(pattern="Checkerboard"):
+    # Tile of thresholds in [0, 1], the overlay goes from dark (0) to bright (1)
+    pattern = pattern.lower()
+    if pattern == "checkerboard":
+        thresholds = np.array([[0.0, 1.0], [1.0, 0.0]])
+    elif pattern.startswith("bayer"):
+        size = int(pattern.split("x")[-1])
+        thresholds = (bayer_matrix(size) + 0.5) / (size * size)
+    elif pattern == "blue noise":
+        thresholds = (blue_noise_matrix() + 0.5) / (BLUE_NOISE_SIZE * BLUE_NOISE_SIZE)
+    else:
+        raise ValueError("Unknown dither pattern: " + str(pattern))
+
+    thresholds.flags.writeable = False
+    return thresholds
+
+
+def overlay_tile(pattern, luma_amplitude):
+    # Overlay color of each cell of the tile, around a neutral 0.5 gray
+    # (for the checkerboard: (1 - amplitude) / 2 and (1 + amplitude) / 2)
+    thresholds = threshold_map(pattern)
+    return ((1.0 + luma_amplitude * (2.0 * thresholds - 1.0)) / 2.0).astype(np.float32)
+
+
+def tiled_mask(tile, height, width, x0=0, y0=0):
+    # Repeat the tile over a (height, width) area whose top left corner
+    # sits at (x0, y0) in the image, so that strips of an image line up.
+    tile_height, tile_width = tile.shape
+    rows = (np.arange(height) + y0) % tile_height
+    cols = (np.arange(width) + x0) % tile_width
+    return tile[rows[:, None], cols[None, :]]
+
+
+def overlay_in_place(img_data, luma_amplitude=0.05, pattern="Checkerboard", x0=0, y0=0):
+    # Overlay blend of the dither tile over a float32 (h, w, 3) buffer in [0, 1].
+    #   a <= 0.5 : 2 * a * b
+    #   a >  0.5 : 1 - 2 * (1 - a) * (1 - b)
+    # The operations are ordered so the results are the same, bit for bit,
+    # as the per pixel formula.
+    height, width, _ = img_data.shape
+    mask = tiled_mask(overlay_tile(pattern, luma_amplitude), height, width, x0, y0)[:, :, None]
+
+    low = img_data <= 0.5
+    np.multiply(img_data, 2 * mask, out=img_data, where=low)
+
+    high = np.logical_not(low, out=low)
+    np.subtract(img_data, 1, out=img_data, where=high)
+    np.multiply(img_data, 1 - mask, out=img_data, where=high)
+    np.multiply(img_data, 2, out=img_data, where=high)
+    np.add(img_data, 1, out=img_data, where=high)
+
+    return img_data
+
+
+def is_error_diffusion(method):
+    return method.lower() in ERROR_DIFFUSION_KERNELS
+
+
+def candidate_cell_bits(palette_size):
+    cell_bits = int(np.log2(CANDIDATE_TABLE_ELEMENTS / max(1, palette_size))) // 3
+    return min(max(cell_bits, 1), MAX_CANDIDATE_CELL_BITS)
+
+
+def palette_candidates(palette, cell_bits=4):
+    # (cells, K) mask of the palette colors that can be the closest to a color of each cell:
+    # the ones not farther from the cell box than the smallest distance within which
+    # another palette color covers the whole box.
+    palette = palette_to_array(palette).astype(np.float64)
+    size = 1 << (8 - cell_bits)
+    cells = np.arange(1 << cell_bits) * size
+    r, g, b = np.meshgrid(cells, cells, cells, indexing="ij")
+    lows = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1).astype(np.float64)
+
+    mask = np.empty((len(lows), len(palette)), dtype=bool)
+    block_size = max(1, MAX_BLOCK_ELEMENTS // (3 * len(palette)))
+    for start in range(0, len(lows), block_size):
+        low = lows[start:start + block_size, None, :]
+        high = low + size
+        outside = np.maximum(np.maximum(low - palette, palette - high), 0.0)
+        farthest = np.maximum(np.abs(palette - low), np.abs(palette - high))
+        bound = (farthest ** 2).sum(axis=2).min(axis=1)
+        # the margin only guards the comparison against rounding, ties must stay candidates
+        mask[start:start + block_size] = (outside ** 2).sum(axis=2) <= bound[:, None] + 1e-6
+    return mask
+
+
+def error_diffusion_indices(img_data, palette, method="Floyd-Steinberg", serpentine=True, strength=1.0, row_callback=None,
+                            lookup="exact", bits_per_gun=4):
+    # Index a (h, w, 3) uint8 buffer onto the palette while diffusing the error.
+    # Inside a row, each pixel depends on the error of the previous one, so the
+    # sweep is sequential; the error sent to the rows below is spread once per row,
+    # with one vectorized add per kernel entry, into a small ring of pending rows.
+    # The closest palette color of a pixel is looked up (see mapping.LOOKUP_MODES):
+    # "exact": among the few candidates of its cell (see palette_candidates), same result as a full search
+    # "binned": in the cached inverse palette of bits_per_gun bits, the error being diffused still
+    #           keeps the average color right
+    kernel = ERROR_DIFFUSION_KERNELS[method.lower()]
+    horizontal = [(dx, weight * strength) for dx, dy, weight in kernel if dy == 0]
+    vertical = [(dx, dy, weight * strength) for dx, dy, weight in kernel if dy > 0]
+    pad = max(abs(dx) for dx, _, _ in kernel)
+    depth = max(dy for _, dy, _ in kernel)
+
+    height, width, _ = img_data.shape
+    palette = palette_to_array(palette)
+    palette_remap = duplicate_palette_remap(palette)
+    palette_list = palette.tolist()
+
+    # cell -> palette index, or -1 when several palette colors are candidates
+    if lookup == "exact":
+        cell_bits = candidate_cell_bits(len(palette))
+        mask = palette_candidates(palette, cell_bits)
+        cell_indices = np.where(mask.sum(axis=1) == 1, mask.argmax(axis=1), -1).tolist()
+        # candidate lists, filled as the cells are met
+        candidates = {}
+    elif lookup == "binned":
+        cell_bits = bits_per_gun
+        cell_indices = get_inverse_palette(palette, bits_per_gun).tolist()
+    else:
+        raise ValueError("Unknown lookup mode: " + str(lookup))
+    shift = 8 - cell_bits
+
+    pending = np.zeros((depth + 1, width + 2 * pad, 3), dtype=np.float32)
+    indices = np.empty((height, width), dtype=np.uint8)
+
+    for y in range(height):
+        if row_callback is not None:
+            row_callback(y, height)
+
+        slot = y % (depth + 1)
+        row = (img_data[y].astype(np.float32) + pending[slot, pad:pad + width]).tolist()
+        pending[slot] = 0
+
+        reverse = serpentine and y % 2 == 1
+        direction = -1 if reverse else 1
+        row_indices = [0] * width
+        row_errors = [None] * width
+
+        for x in (range(width - 1, -1, -1) if reverse else range(width)):
+            r, g, b = row[x]
+            # clipped, the comparisons are cheaper than min() / max() calls
+            r = 0.0 if r < 0.0 else 255.0 if r > 255.0 else r
+            g = 0.0 if g < 0.0 else 255.0 if g > 255.0 else g
+            b = 0.0 if b < 0.0 else 255.0 if b > 255.0 else b
+
+            cell = (((int(r) >> shift << cell_bits) | (int(g) >> shift)) << cell_bits) | (int(b) >> shift)
+            best_index = cell_indices[cell]
+            if best_index < 0:
+                cell_palette = candidates.get(cell)
+                if cell_palette is None:
+                    cell_palette = candidates[cell] = np.flatnonzero(mask[cell]).tolist()
+
+                # closest palette color, first one on ties
+                best_index = 0
+                best_distance = None
+                for index in cell_palette:
+                    pr, pg, pb = palette_list[index]
+                    distance = (r - pr) ** 2 + (g - pg) ** 2 + (b - pb) ** 2
+                    if best_distance is None or distance < best_distance:
+                        best_distance = distance
+                        best_index = index
+
+            pr, pg, pb = palette_list[best_index]
+            er, eg, eb = r - pr, g - pg, b - pb
+            for dx, weight in horizontal:
+                nx = x + dx * direction
+                if 0 <= nx < width:
+                    neighbour = row[nx]
+                    neighbour[0] += er * weight
+                    neighbour[1] += eg * weight
+                    neighbour[2] += eb * weight
+
+            row_indices[x] = best_index
+            row_errors[x] = (er, eg, eb)
+
+        row_errors = np.array(row_errors, dtype=np.float32)
+        for dx, dy, weight in vertical:
+            if y + dy < height:
+                start = pad + dx * direction
+                pending[(y + dy) % (depth + 1), start:start + width] += weight * row_errors
+
+        indices[y] = palette_remap[row_indices]
+
+    return indices
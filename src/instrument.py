@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Counts recorded by the code running inside a stage (see add_count),
+# one stack of open stages per thread
+_active_stages = threading.local()
+
+
+def add_count(name, value=1):
+    # Add to a counter of the innermost open stage of this thread, if any
+    # (e.g. the retries of the quantizers)
+    stack = getattr(_active_stages, "stack", None)
+    if stack:
+        counts = stack[-1]
+        counts[name] = counts.get(name, 0) + value
+
+
+class Tracer(object):
+    """Wall time, CPU time and item counts of the conversion stages.
+    The CPU time is the one of the whole process, so that it includes the
+    BLAS / OpenMP threads. A disabled tracer records nothing.
+    """
+    def __init__(self, enabled=True, **context):
+        self.enabled = enabled
+        self.context = context    # added to the arguments of every event (e.g. the image name)
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        # with tracer.stage("quantize", method="Kmeans") as counts:
+        #     ...
+        #     counts["colors"] = len(palette)
+        if not self.enabled:
+            yield counts
+            return
+
+        stack = getattr(_active_stages, "stack", None)
+        if stack is None:
+            stack = _active_stages.stack = []
+        stack.append(counts)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield counts
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            stack.pop()
+            event = {"name": name, "start": start, "wall": wall, "cpu": cpu,
+                     "pid": os.getpid(), "tid": threading.get_ident(),
+                     "args": dict(self.context, **counts)}
+            with self.lock:
+                self.events.append(event)
+
+    def extend(self, events):
+        # events recorded by another tracer, e.g. in a worker process
+        with self.lock:
+            self.events.extend(events)
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+
+    def write(self, filename):
+        # Chrome trace for .json files (chrome://tracing, Perfetto), JSON lines otherwise
+        if filename.lower().endswith(".json"):
+            write_chrome_trace(self.events, filename)
+        else:
+            write_json_lines(self.events, filename)
+
+
+def write_json_lines(events, filename):
+    with open(filename, "w") as file:
+        for event in sorted(events, key=lambda event: event["start"]):
+            file.write(json.dumps(event, sort_keys=True, default=str) + "\n")
+
+
+def write_chrome_trace(events, filename):
+    # complete ("X") events, times in microseconds
+    trace_events = [{"name": event["name"], "cat": "colorpal", "ph": "X",
+                     "ts": event["start"] * 1e6, "dur": event["wall"] * 1e6,
+                     "pid": event["pid"], "tid": event["tid"],
+                     "args": dict(event["args"], cpu_ms=event["cpu"] * 1000)}
+                    for event in sorted(events, key=lambda event: event["start"])]
+    with open(filename, "w") as file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file, default=str)
@@ -1,15 +1,38 @@
 # -*- coding: utf-8 -*-
 
 import os
+import math
+import time
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, ttk
+from collections import OrderedDict
+import numpy as np
 from PIL import Image, ImageTk
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from quantize import png_24bit_to_indexed, build_color_list_from_image, quantize_colors, apply_dither_overlay, sort_palette_by_luminance
+from pipeline import ConversionPipeline, PipelineConfig, ConversionCancelled
+from palette_cache import open_palette_cache
+from instrument import Tracer
+from parallel import default_workers
+from dither import DITHER_PATTERNS, ERROR_DIFFUSION_METHODS
+from colorspace import COLOR_SPACES
 from raw import export_image_to_raw
 from plot import plot_colors
 
+# How often the conversion running in the background is checked for progress
+CONVERSION_POLL_MS = 50
+
+# Live reload: a modified file is read again once it has not changed for RELOAD_SETTLE_MS
+RELOAD_POLL_MS = 100
+RELOAD_SETTLE_MS = 300
+
+# The zoomed image is rendered by tiles, only those in the viewport,
+# and the last rendered tiles are kept for each image version and zoom level
+RENDER_TILE_SIZE = 512
+RENDER_CACHE_TILES = 64
+
 class ImageViewer(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -20,16 +43,53 @@ class ImageViewer(tk.Tk):
         self.palette_size = 16
 
         self.dither_intensity = 0.05
+        self.dither_pattern = tk.StringVar(value=DITHER_PATTERNS[0])
 
         self.zoom_factor = 3.0
         self.zoom_factors = [0.25, 0.5, 1.0, 1.5,
                              2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
         
+        # Rendered tiles: {(image version, zoom, tile x, tile y): PhotoImage}
+        self.render_cache = OrderedDict()
+        self.render_source = None
+        self.render_version = 0
+        self.tile_items = {}
+
         self.palette_root = None
         self.plot3d = None
         
         self.conversion_mode = tk.StringVar(value="Kmeans")
-        self.mode_options = ["Kmeans", "MMCQ", "Kmeans + MMCQ", "Median Cut", "Kmeans + Median Cut", "Popularity"]
+        self.mode_options = ["Kmeans", "MMCQ", "Kmeans + MMCQ", "Median Cut", "Kmeans + Median Cut", "Popularity", "Grid Kmeans", "Auto"]
+
+        # Exact 24 bits nearest color search, or faster lookup binned at the palette bit depth
+        self.fast_lookup = tk.BooleanVar(value=False)
+
+        # Space of the color distances (KMeans clustering and palette lookup)
+        self.color_space = tk.StringVar(value=COLOR_SPACES[0])
+
+        # Palettes already computed, in this session or a previous one
+        self.palette_cache = open_palette_cache()
+
+        # Time spent in each conversion stage, see File > Save trace
+        self.tracer = Tracer(image="")
+
+        # Background conversion: the worker thread posts its progress and result to the queue,
+        # the generation of the newest request cancels the older ones
+        self.conversion_queue = queue.Queue()
+        self.conversion_generation = 0
+        self.conversion_running = False
+        self.conversion_poll = None
+
+        # Colors, palette and quantizer settings of the last conversion: when a reloaded
+        # image has the same colors, its palette is reused
+        self.last_conversion = None
+
+        # Live reload: the watchdog thread posts the modified paths to the queue,
+        # the GUI thread waits for the file to settle before reading it
+        self.reload_queue = queue.Queue()
+        self.reload_poll = None
+        self.reload_deadline = None
+        self.reload_signature = None
         
         self.file_path = None
         self.file_observer = None
@@ -55,6 +115,9 @@ class ImageViewer(tk.Tk):
         file_menu.add_command(label="Save image as RAW", command=self.save_file_as_raw, accelerator="Ctrl+Shift+S")
         self.bind_all("<Control-Shift-s>", self.save_file_as_raw)
 
+        file_menu.add_separator()
+        file_menu.add_command(label="Save trace", command=self.save_trace)
+
         # Operations
         control_frame = tk.Frame(self)
         control_frame.pack(side=tk.TOP, pady=10)
@@ -72,9 +135,6 @@ class ImageViewer(tk.Tk):
             control_frame, text="+", command=self.zoom_in)
         zoom_in_button.pack(side=tk.LEFT)
 
-        self.label = tk.Label(self)
-        self.label.pack(expand=True, padx=5, pady=0)
-
         # Separator
         separator = tk.Canvas(control_frame, width=2, height=10, bg="gray")
         separator.pack(side=tk.LEFT, padx=5, pady=5)
@@ -106,8 +166,21 @@ class ImageViewer(tk.Tk):
             control_frame, text="+", command=self.dither_inc)
         dither_inc_button.pack(side=tk.LEFT)
 
-        self.label = tk.Label(self)
-        self.label.pack(expand=True, padx=5, pady=5)
+        self.dither_pattern_selector = ttk.Combobox(control_frame, values=DITHER_PATTERNS + ERROR_DIFFUSION_METHODS, textvariable=self.dither_pattern, width=12)
+        self.dither_pattern_selector.pack(side=tk.LEFT, padx=5)
+        self.dither_pattern_selector.bind("<<ComboboxSelected>>", self.settings_changed)
+
+        # Image, with scroll bars
+        view_frame = tk.Frame(self)
+        view_frame.pack(side=tk.TOP, expand=True, fill=tk.BOTH, padx=5, pady=5)
+
+        self.canvas = tk.Canvas(view_frame, highlightthickness=0)
+        x_scrollbar = tk.Scrollbar(view_frame, orient=tk.HORIZONTAL, command=self.on_x_scroll)
+        y_scrollbar = tk.Scrollbar(view_frame, orient=tk.VERTICAL, command=self.on_y_scroll)
+        self.canvas.config(xscrollcommand=x_scrollbar.set, yscrollcommand=y_scrollbar.set)
+        x_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
+        y_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
 
         # Separator
         separator = tk.Canvas(control_frame, width=2, height=10, bg="gray")
@@ -115,6 +188,14 @@ class ImageViewer(tk.Tk):
 
         self.mode_selector = ttk.Combobox(control_frame, values=self.mode_options, textvariable=self.conversion_mode)
         self.mode_selector.pack(side=tk.LEFT, padx=5)
+        self.mode_selector.bind("<<ComboboxSelected>>", self.settings_changed)
+
+        self.fast_lookup_button = tk.Checkbutton(control_frame, text="Fast lookup", variable=self.fast_lookup, command=self.settings_changed)
+        self.fast_lookup_button.pack(side=tk.LEFT, padx=5)
+
+        self.color_space_selector = ttk.Combobox(control_frame, values=COLOR_SPACES, textvariable=self.color_space, width=7)
+        self.color_space_selector.pack(side=tk.LEFT, padx=5)
+        self.color_space_selector.bind("<<ComboboxSelected>>", self.settings_changed)
 
         # Separator
         separator = tk.Canvas(control_frame, width=2, height=10, bg="gray")
@@ -129,44 +210,132 @@ class ImageViewer(tk.Tk):
         self.progress.pack(side=tk.BOTTOM, pady=5)
 
         # Bind mouse wheel event
-        self.label.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+
+        # Pan with the mouse, render the tiles that come into view
+        self.canvas.bind("<ButtonPress-1>", lambda event: self.canvas.scan_mark(event.x, event.y))
+        self.canvas.bind("<B1-Motion>", self.on_pan)
+        self.canvas.bind("<Configure>", self.render_viewport)
 
     
     def update_progress_bar(self, v):
         self.progress["value"] = v
-        self.progress.update()
+
+
+    def pipeline_config(self):
+        return PipelineConfig(
+            palette_size=self.palette_size,
+            method=self.conversion_mode.get(),
+            bits_per_gun=4,
+            dither_intensity=self.dither_intensity,
+            dither_pattern=self.dither_pattern.get(),
+            lookup="binned" if self.fast_lookup.get() else "exact",
+            color_space=self.color_space.get(),
+        )
 
 
     def calculate_palette(self):
         if self.original_image is not None:
-            original_palette = build_color_list_from_image(self.original_image, self.update_progress_bar, 0, 20)
-
-            self.update_progress_bar(30)
             print("combo box conservion mode : " + self.conversion_mode.get())
-            unsorted_reduced_palette = quantize_colors(original_palette, self.palette_size, self.conversion_mode.get(), 4)
+            self.start_conversion()
+
+
+    def start_conversion(self, reuse_palette=False):
+        # The conversion runs on a worker thread, a conversion still in flight
+        # is cancelled: the newest request wins
+        # reuse_palette: keep the last palette if the image colors did not change
+        self.conversion_generation += 1
+        self.tracer.context["image"] = os.path.basename(self.file_path or "")
+        pipeline = ConversionPipeline(self.pipeline_config(), self.palette_cache, self.tracer, default_workers())
+        last_conversion = self.last_conversion if reuse_palette else None
+        worker = threading.Thread(target=self.conversion_worker,
+                                  args=(pipeline, self.original_image, self.conversion_generation, last_conversion), daemon=True)
+        self.update_progress_bar(0)
+        worker.start()
+
+        self.conversion_running = True
+        if self.conversion_poll is None:
+            self.conversion_poll = self.after(CONVERSION_POLL_MS, self.poll_conversion)
+
+
+    def conversion_worker(self, pipeline, image, generation, last_conversion=None):
+        # Worker thread: no Tk calls here, everything goes through the queue
+        def progress(v, *args):
+            if generation != self.conversion_generation:
+                raise ConversionCancelled()
+            self.conversion_queue.put(("progress", generation, v))
 
-            self.update_progress_bar(40)
-            reduced_palette = sort_palette_by_luminance(unsorted_reduced_palette)
-
-            if self.dither_intensity > 0.0:
-                pre_processed_img = apply_dither_overlay(self.original_image, self.dither_intensity, self.update_progress_bar, 50, 60)
+        try:
+            colors, counts = pipeline.extract_colors(image, progress, 0, 20)
+
+            # only the pixels changed: same colors, same settings, same palette
+            palette = None
+            parameters = pipeline.config.quantizer_parameters()
+            if last_conversion is not None:
+                last_colors, last_palette, last_parameters = last_conversion
+                if last_parameters == parameters and np.array_equal(last_colors, colors):
+                    palette = last_palette
+
+            converted_image, palette = pipeline.run(image, progress, palette, (colors, counts))
+            self.conversion_queue.put(("done", generation, (converted_image, palette, (colors, palette, parameters))))
+        except ConversionCancelled:
+            pass
+        except Exception as e:
+            self.conversion_queue.put(("error", generation, e))
+
+
+    def cancel_conversion(self):
+        self.conversion_generation += 1
+        self.conversion_running = False
+
+
+    def poll_conversion(self):
+        self.conversion_poll = None
+        while True:
+            try:
+                kind, generation, value = self.conversion_queue.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.conversion_generation:
+                # message from a cancelled conversion
+                continue
+
+            if kind == "progress":
+                self.update_progress_bar(value)
+            elif kind == "done":
+                self.conversion_running = False
+                previous_palette = self.last_conversion[1] if self.last_conversion is not None else None
+                self.converted_image, reduced_palette, self.last_conversion = value
+
+                if reduced_palette != previous_palette:
+                    self.palette_root = display_palette(self.palette_root, reduced_palette)
+                    self.plot3d = plot_colors(reduced_palette)
+
+                self.update_progress_bar(100)
+                self.display_image()
             else:
-                pre_processed_img = self.original_image
+                self.conversion_running = False
+                self.update_progress_bar(0)
+                print("Conversion failed: " + str(value))
 
-            self.converted_image = png_24bit_to_indexed(pre_processed_img, reduced_palette, self.update_progress_bar, 60, 80)
+        if self.conversion_running:
+            self.conversion_poll = self.after(CONVERSION_POLL_MS, self.poll_conversion)
 
-            self.update_progress_bar(90)
-            self.palette_root = display_palette(self.palette_root, reduced_palette)
-            self.plot3d = plot_colors(reduced_palette)
 
-            self.update_progress_bar(100)
-            self.display_image()
+    def settings_changed(self, event=None):
+        # restart the conversion in flight with the new settings
+        if self.conversion_running and self.original_image is not None:
+            self.start_conversion()
 
 
     def open_file(self, a=None):
         file_name = filedialog.askopenfilename(filetypes=[("PNG Files", "*.png")])
 
         if file_name:
+            self.cancel_conversion()
+            self.last_conversion = None
             self.file_path = file_name
             self.original_image = Image.open(file_name)
             self.converted_image = None
@@ -182,31 +351,95 @@ class ImageViewer(tk.Tk):
     def save_file_as_raw(self, a=None):
         file_path = filedialog.asksaveasfilename(defaultextension=".RAW")
         if file_path and self.converted_image is not None:
-            debug_image = export_image_to_raw(self.converted_image, file_path)
+            with self.tracer.stage("export", pixels=self.converted_image.width * self.converted_image.height):
+                debug_image = export_image_to_raw(self.converted_image, file_path)
             if debug_image is not None:
                 self.converted_image = debug_image
                 self.display_image() # for debug purpose
 
 
+    def save_trace(self, a=None):
+        # Chrome trace (chrome://tracing, Perfetto) or JSON lines, after the extension
+        file_path = filedialog.asksaveasfilename(defaultextension=".json",
+                                                 filetypes=[("Chrome trace", "*.json"), ("JSON lines", "*.jsonl")])
+        if file_path:
+            self.tracer.write(file_path)
+
 
     def watch_file(self):
         if self.file_observer is not None:
             self.file_observer.stop()
 
+        # editors either write the file in place, or write a new file and rename it
         event_handler = FileSystemEventHandler()
         event_handler.on_modified = self.on_file_modified
+        event_handler.on_created = self.on_file_modified
+        event_handler.on_moved = self.on_file_modified
 
         self.file_observer = Observer()
         self.file_observer.schedule(event_handler, os.path.dirname(self.file_path), recursive=False)
         self.file_observer.start()
 
+        self.reload_signature = self.file_signature()
+        self.reload_deadline = None
+        if self.reload_poll is None:
+            self.reload_poll = self.after(RELOAD_POLL_MS, self.poll_reload)
+
 
     def on_file_modified(self, event):
-        modified_file_path = os.path.join(event.src_path, os.path.basename(self.file_path))
-        print(event)
-        print(modified_file_path, " =? ", self.file_path)
-        if os.path.abspath(modified_file_path) == os.path.abspath(self.file_path):
-            self.original_image = Image.open(self.file_path)
+        # Watchdog thread: no Tk calls here, the path is handed to the GUI thread
+        file_path = self.file_path
+        for path in [event.src_path, getattr(event, "dest_path", None)]:
+            if path and file_path and os.path.abspath(path) == os.path.abspath(file_path):
+                self.reload_queue.put(path)
+
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_size, stat.st_mtime_ns
+        except OSError:
+            return None
+
+
+    def poll_reload(self):
+        # Debounce: an editor fires several events per save, the file is read
+        # once it stopped changing for RELOAD_SETTLE_MS
+        self.reload_poll = None
+        modified = False
+        while True:
+            try:
+                self.reload_queue.get_nowait()
+                modified = True
+            except queue.Empty:
+                break
+
+        now = time.monotonic() * 1000
+        signature = self.file_signature()
+        if modified or signature != self.reload_signature:
+            self.reload_deadline = now + RELOAD_SETTLE_MS
+            self.reload_signature = signature
+
+        if self.reload_deadline is not None and now >= self.reload_deadline and signature is not None:
+            self.reload_deadline = None
+            self.reload_file()
+
+        self.reload_poll = self.after(RELOAD_POLL_MS, self.poll_reload)
+
+
+    def reload_file(self):
+        try:
+            image = Image.open(self.file_path)
+            image.load()
+        except Exception as e:
+            # e.g. not fully written yet, it is read again on its next change
+            print("Reload failed: " + str(e))
+            return
+
+        self.original_image = image
+        if self.converted_image is not None or self.conversion_running:
+            self.start_conversion(reuse_palette=True)
+        else:
             self.display_image()
 
 
@@ -217,20 +450,110 @@ class ImageViewer(tk.Tk):
         else:
             displayed_image = self.original_image
 
-        if self.zoom_factor > 1.0:
-            resample_method = Image.NEAREST
+        if displayed_image is not self.render_source:
+            # new image version, the tiles of the previous one are not shown anymore
+            self.render_source = displayed_image
+            self.render_version += 1
+
+        if displayed_image is None:
+            self.canvas.delete("all")
+            self.tile_items = {}
+            return
+
+        self.canvas.config(scrollregion=(0, 0, int(displayed_image.width * self.zoom_factor),
+                                         int(displayed_image.height * self.zoom_factor)))
+        self.render_viewport()
+
+
+    def render_viewport(self, event=None):
+        # Show the tiles of the zoomed image that are in the viewport, and only them
+        source = self.render_source
+        if source is None:
+            return
+        zoom = self.zoom_factor
+        width = int(source.width * zoom)
+        height = int(source.height * zoom)
+
+        left = max(int(self.canvas.canvasx(0)), 0)
+        top = max(int(self.canvas.canvasy(0)), 0)
+        right = min(left + self.canvas.winfo_width(), width)
+        bottom = min(top + self.canvas.winfo_height(), height)
+
+        visible = set()
+        for tile_y in range(top // RENDER_TILE_SIZE, math.ceil(bottom / RENDER_TILE_SIZE)):
+            for tile_x in range(left // RENDER_TILE_SIZE, math.ceil(right / RENDER_TILE_SIZE)):
+                visible.add((self.render_version, zoom, tile_x, tile_y))
+
+        for key in list(self.tile_items):
+            if key not in visible:
+                self.canvas.delete(self.tile_items.pop(key)[0])
+
+        for key in visible:
+            if key not in self.tile_items:
+                tile_image = self.render_tile(key, width, height)
+                item = self.canvas.create_image(key[2] * RENDER_TILE_SIZE, key[3] * RENDER_TILE_SIZE,
+                                                anchor=tk.NW, image=tile_image)
+                self.tile_items[key] = (item, tile_image)
+
+
+    def render_tile(self, key, width, height):
+        if key in self.render_cache:
+            self.render_cache.move_to_end(key)
+            return self.render_cache[key]
+
+        _, zoom, tile_x, tile_y = key
+        source = self.render_source
+        x0, y0 = tile_x * RENDER_TILE_SIZE, tile_y * RENDER_TILE_SIZE
+        x1, y1 = min(x0 + RENDER_TILE_SIZE, width), min(y0 + RENDER_TILE_SIZE, height)
+
+        if zoom >= 1.0:
+            # nearest neighbour, each display pixel takes the source pixel under its center:
+            # the tiles line up exactly, whatever the zoom
+            columns = ((np.arange(x0, x1) + 0.5) / zoom).astype(np.int64)
+            rows = ((np.arange(y0, y1) + 0.5) / zoom).astype(np.int64)
+            area = source.crop((int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1))
+            tile = Image.fromarray(np.asarray(area)[np.ix_(rows - rows[0], columns - columns[0])])
+            if area.mode == "P":
+                tile.putpalette(area.getpalette())
         else:
-            resample_method = Image.ANTIALIAS
+            # the area of the source image under the tile, in (fractional) source pixels
+            box = (x0 / zoom, y0 / zoom, min(x1 / zoom, source.width), min(y1 / zoom, source.height))
+            tile = source.resize((x1 - x0, y1 - y0), resample=Image.LANCZOS, box=box)
+        tile_image = ImageTk.PhotoImage(tile)
 
-        image = displayed_image.resize(
-            (int(displayed_image.width * self.zoom_factor),
-             int(displayed_image.height * self.zoom_factor)),
-            resample=resample_method,
-        )
-        tk_image = ImageTk.PhotoImage(image)
+        self.render_cache[key] = tile_image
+        while len(self.render_cache) > RENDER_CACHE_TILES:
+            self.render_cache.popitem(last=False)
+        return tile_image
+
+
+    def on_x_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.render_viewport()
+
+
+    def on_y_scroll(self, *args):
+        self.canvas.yview(*args)
+        self.render_viewport()
 
-        self.label.config(image=tk_image)
-        self.label.image = tk_image
+
+    def on_pan(self, event):
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.render_viewport()
+
+
+    def set_zoom(self, zoom_factor):
+        # keep the center of the viewport in place
+        x_center = sum(self.canvas.xview()) / 2
+        y_center = sum(self.canvas.yview()) / 2
+        self.zoom_factor = zoom_factor
+        self.display_image()
+        self.update_idletasks()
+        x_first, x_last = self.canvas.xview()
+        y_first, y_last = self.canvas.yview()
+        self.canvas.xview_moveto(x_center - (x_last - x_first) / 2)
+        self.canvas.yview_moveto(y_center - (y_last - y_first) / 2)
+        self.render_viewport()
 
 
     def update_zoom_label(self):
@@ -240,16 +563,14 @@ class ImageViewer(tk.Tk):
     def zoom_in(self):
         if self.zoom_factor < self.zoom_factors[-1]:
             current_index = self.zoom_factors.index(self.zoom_factor)
-            self.zoom_factor = self.zoom_factors[current_index + 1]
-            self.display_image()
+            self.set_zoom(self.zoom_factors[current_index + 1])
             self.update_zoom_label()
 
 
     def zoom_out(self):
         if self.zoom_factor > self.zoom_factors[0]:
             current_index = self.zoom_factors.index(self.zoom_factor)
-            self.zoom_factor = self.zoom_factors[current_index - 1]
-            self.display_image()
+            self.set_zoom(self.zoom_factors[current_index - 1])
             self.update_zoom_label()
 
 
@@ -265,12 +586,14 @@ class ImageViewer(tk.Tk):
         if self.palette_size < 256:
             self.palette_size += 1
             self.update_palette_size_label()
+            self.settings_changed()
 
 
     def palette_size_dec(self):
         if self.zoom_factor > 0:
             self.palette_size -= 1
             self.update_palette_size_label()
+            self.settings_changed()
 
     # Dither intensity
     def update_dither_label(self):
@@ -281,16 +604,18 @@ class ImageViewer(tk.Tk):
         if self.dither_intensity < 1.0:
             self.dither_intensity += 0.025
             self.update_dither_label()
+            self.settings_changed()
 
 
     def dither_dec(self):
         if self.dither_intensity > 0.0:
             self.dither_intensity -= 0.025
             self.update_dither_label()
+            self.settings_changed()
 
 
     def on_mouse_wheel(self, event):
-        if event.delta > 0:
+        if event.delta > 0 or event.num == 4:
             self.zoom_in()
         else:
             self.zoom_out()
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+
+# Kept in the output directory of the batch conversions
+MANIFEST_NAME = "colorpal-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class BuildManifest(object):
+    """Record of the previous conversions of a batch output directory:
+    for each source (path relative to the source directory) the hash of its
+    content, the conversion parameters and the hash of every output file.
+    """
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, MANIFEST_NAME)
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return self
+        if content.get("version") == MANIFEST_VERSION:
+            self.entries = content.get("entries", {})
+        return self
+
+    def save(self):
+        # write a temporary file first, so that an interrupted build never leaves a truncated manifest
+        os.makedirs(self.dest_dir, exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def output_key(self, path):
+        # outputs are stored relative to the manifest, the debug directory can live elsewhere
+        return os.path.relpath(path, self.dest_dir)
+
+    def output_path(self, key):
+        return os.path.normpath(os.path.join(self.dest_dir, key))
+
+    def source_hash(self, source_dir, relative_path):
+        # the content hash is only computed again when the size or modification time changed
+        path = os.path.join(source_dir, relative_path)
+        stat = os.stat(path)
+        entry = self.entries.get(relative_path)
+        if entry is not None and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return entry["source_hash"], stat
+        return file_hash(path), stat
+
+    def is_up_to_date(self, relative_path, source_hash, params):
+        entry = self.entries.get(relative_path)
+        if entry is None or entry["source_hash"] != source_hash or entry["params"] != params:
+            return False
+        for key, output_hash in entry["outputs"].items():
+            path = self.output_path(key)
+            if not os.path.exists(path) or file_hash(path) != output_hash:
+                return False
+        return True
+
+    def record(self, relative_path, source_hash, stat, params, outputs):
+        # outputs of a previous conversion that are not produced anymore are deleted
+        previous = self.entries.get(relative_path, {}).get("outputs", {})
+        for key in set(previous) - set(self.output_key(path) for path in outputs):
+            if os.path.exists(self.output_path(key)):
+                os.remove(self.output_path(key))
+
+        self.entries[relative_path] = {
+            "source_hash": source_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "params": params,
+            "outputs": {self.output_key(path): file_hash(path) for path in outputs},
+        }
+
+    def forget(self, relative_path):
+        self.entries.pop(relative_path, None)
+
+    def remove_orphans(self, sources):
+        # delete the outputs of the sources that are gone, returns the deleted files
+        removed = []
+        for relative_path in sorted(set(self.entries) - set(sources)):
+            for key in self.entries[relative_path]["outputs"]:
+                path = self.output_path(key)
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed.append(path)
+            self.forget(relative_path)
+        return removed
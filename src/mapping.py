@@ -0,0 +1,118 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from colorspace import is_rgb, to_color_space, grid_colors, grid_color_table
+
+
+# Upper bound on the (pixels x palette entries) distance matrix
+# computed at once, so memory stays flat whatever the image size.
+MAX_BLOCK_ELEMENTS = 1 << 21
+
+# Lookup modes
+# "exact": nearest palette color for each 24 bits pixel
+# "binned": pixels are first reduced to the target bit depth,
+#           then mapped through a precomputed cell -> palette index table
+LOOKUP_MODES = ["exact", "binned"]
+
+# How many inverse palette tables are kept around
+INVERSE_PALETTE_CACHE_SIZE = 32
+_inverse_palette_cache = OrderedDict()
+
+
+def palette_to_array(palette):
+    return np.asarray(palette, dtype=np.int32).reshape(-1, 3)
+
+
+def duplicate_palette_remap(palette):
+    # When a color is present several times in the palette,
+    # the historical dictionnary based lookup resolved it to the last index.
+    # Keep the same behavior by redirecting every entry to its last duplicate.
+    last_index = {}
+    for idx, color in enumerate(palette.tolist()):
+        last_index[tuple(color)] = idx
+    return np.array([last_index[tuple(color)] for color in palette.tolist()], dtype=np.intp)
+
+
+def rows_per_block(width, palette_size):
+    return max(1, MAX_BLOCK_ELEMENTS // max(1, width * palette_size))
+
+
+def nearest_palette_indices(pixels, palette, color_space="RGB"):
+    # pixels: (N, 3) array, palette: (K, 3) array
+    # returns the index of the closest palette color (squared euclidean distance
+    # in color_space, see colorspace.COLOR_SPACES)
+    # ties are resolved towards the first palette entry, like min() does.
+    return nearest_points(to_color_space(pixels, color_space), to_color_space(palette_to_array(palette), color_space))
+
+
+def nearest_points(points, palette_points):
+    # points: (N, 3) float32 array, palette_points: (K, 3) float32 array,
+    # already converted to the color space of the distance
+    #
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 is the same for every
+    # palette entry so it can be dropped. With 8 bits RGB components every
+    # intermediate value stays below 2^24, hence exact in float32,
+    # which lets the dot product run through BLAS without changing the result.
+    distances = points @ (-2.0 * palette_points.T)
+    distances += np.einsum("ij,ij->i", palette_points, palette_points)[None, :]
+
+    return np.argmin(distances, axis=1)
+
+
+def palette_hash(palette):
+    return hashlib.sha1(palette_to_array(palette).tobytes()).hexdigest()
+
+
+def pixels_to_cells(pixels, bits_per_gun=4):
+    # Reduce each pixel to the target bit depth and pack it as a single cell number
+    pixels = np.asarray(pixels).reshape(-1, 3)
+    shift = 8 - bits_per_gun
+    r = (pixels[:, 0] >> shift).astype(np.intp)
+    g = (pixels[:, 1] >> shift).astype(np.intp)
+    b = (pixels[:, 2] >> shift).astype(np.intp)
+    return (r << (2 * bits_per_gun)) | (g << bits_per_gun) | b
+
+
+def build_inverse_palette(palette, bits_per_gun=4, color_space="RGB"):
+    # For each cell of the reduced color space, find the closest palette entry.
+    # The cell color is spread over the full 0-255 range (0x0 -> 0, 0xF -> 255 in RGB444)
+    # so that the colors of a palette quantized at this depth map onto themselves.
+    palette = palette_to_array(palette)
+    if is_rgb(color_space):
+        nearest = nearest_palette_indices(grid_colors(bits_per_gun), palette)
+    else:
+        # the cells are converted once for all the palettes
+        nearest = nearest_points(grid_color_table(bits_per_gun, color_space), to_color_space(palette, color_space))
+
+    table = duplicate_palette_remap(palette)[nearest]
+    table = table.astype(np.uint8 if len(palette) <= 256 else np.int32)
+    table.flags.writeable = False
+    return table
+
+
+def get_inverse_palette(palette, bits_per_gun=4, color_space="RGB"):
+    # LRU cache of the inverse palette tables, keyed by palette hash, bit depth and color space
+    key = (palette_hash(palette), bits_per_gun, color_space.lower())
+    table = _inverse_palette_cache.get(key)
+    if table is None:
+        table = build_inverse_palette(palette, bits_per_gun, color_space)
+        _inverse_palette_cache[key] = table
+        if len(_inverse_palette_cache) > INVERSE_PALETTE_CACHE_SIZE:
+            _inverse_palette_cache.popitem(last=False)
+    else:
+        _inverse_palette_cache.move_to_end(key)
+    return table
+
+
+def binned_palette_indices(pixels, palette, bits_per_gun=4, color_space="RGB"):
+    return np.take(get_inverse_palette(palette, bits_per_gun, color_space), pixels_to_cells(pixels, bits_per_gun))
+
+
+def palette_indices(pixels, palette, lookup="exact", bits_per_gun=4, color_space="RGB"):
+    if lookup == "exact":
+        return duplicate_palette_remap(palette_to_array(palette))[nearest_palette_indices(pixels, palette, color_space)]
+    if lookup == "binned":
+        return binned_palette_indices(pixels, palette, bits_per_gun, color_space)
+    raise ValueError("Unknown lookup mode: " + str(lookup))
@@ -10,10 +10,15 @@
 """
 __version__ = '0.2.1'
 
+import heapq
 import math
 
+import numpy as np
 from PIL import Image
 
+from colorspace import is_rgb, to_color_space
+from mapping import palette_indices
+
 
 class cached_property(object):
     """Decorator that creates converts a method with a single
@@ -42,37 +47,20 @@ class MMCQ(object):
         return (r << (2 * MMCQ.SIGBITS)) + (g << MMCQ.SIGBITS) + b
 
     @staticmethod
-    def get_histo(pixels):
-        """histo (1-d array, giving the number of pixels in each quantized
-        region of color space)
+    def get_histo(pixels, weights=None, sigbits=None):
+        """histo (3-d array, giving the number of pixels in each quantized
+        region of color space, along with its cumulative moment tables)
+
+        :param weights: optional pixel count of each entry of pixels
+        :param sigbits: significant bits per component, MMCQ.SIGBITS by default
         """
-        histo = dict()
-        for pixel in pixels:
-            rval = pixel[0] >> MMCQ.RSHIFT
-            gval = pixel[1] >> MMCQ.RSHIFT
-            bval = pixel[2] >> MMCQ.RSHIFT
-            index = MMCQ.get_color_index(rval, gval, bval)
-            histo[index] = histo.setdefault(index, 0) + 1
-        return histo
+        return Histogram(pixels, weights, MMCQ.SIGBITS if sigbits is None else sigbits)
 
     @staticmethod
     def vbox_from_pixels(pixels, histo):
-        rmin = 1000000
-        rmax = 0
-        gmin = 1000000
-        gmax = 0
-        bmin = 1000000
-        bmax = 0
-        for pixel in pixels:
-            rval = pixel[0] >> MMCQ.RSHIFT
-            gval = pixel[1] >> MMCQ.RSHIFT
-            bval = pixel[2] >> MMCQ.RSHIFT
-            rmin = min(rval, rmin)
-            rmax = max(rval, rmax)
-            gmin = min(gval, gmin)
-            gmax = max(gval, gmax)
-            bmin = min(bval, bmin)
-            bmax = max(bval, bmax)
+        cells = np.asarray(pixels, dtype=np.int64).reshape(-1, 3) >> histo.rshift
+        rmin, gmin, bmin = cells.min(axis=0).tolist()
+        rmax, gmax, bmax = cells.max(axis=0).tolist()
         return VBox(rmin, rmax, gmin, gmax, bmin, bmax, histo)
 
     @staticmethod
@@ -88,49 +76,24 @@ class MMCQ(object):
         if vbox.count == 1:
             return (vbox.copy, None)
         # Find the partial sum arrays along the selected axis.
-        total = 0
-        sum_ = 0
-        partialsum = {}
-        lookaheadsum = {}
-        do_cut_color = None
         if maxw == rw:
             do_cut_color = 'r'
-            for i in range(vbox.r1, vbox.r2+1):
-                sum_ = 0
-                for j in range(vbox.g1, vbox.g2+1):
-                    for k in range(vbox.b1, vbox.b2+1):
-                        index = MMCQ.get_color_index(i, j, k)
-                        sum_ += histo.get(index, 0)
-                total += sum_
-                partialsum[i] = total
         elif maxw == gw:
             do_cut_color = 'g'
-            for i in range(vbox.g1, vbox.g2+1):
-                sum_ = 0
-                for j in range(vbox.r1, vbox.r2+1):
-                    for k in range(vbox.b1, vbox.b2+1):
-                        index = MMCQ.get_color_index(j, i, k)
-                        sum_ += histo.get(index, 0)
-                total += sum_
-                partialsum[i] = total
         else:  # maxw == bw
             do_cut_color = 'b'
-            for i in range(vbox.b1, vbox.b2+1):
-                sum_ = 0
-                for j in range(vbox.r1, vbox.r2+1):
-                    for k in range(vbox.g1, vbox.g2+1):
-                        index = MMCQ.get_color_index(j, k, i)
-                        sum_ += histo.get(index, 0)
-                total += sum_
-                partialsum[i] = total
-        for i, d in partialsum.items():
-            lookaheadsum[i] = total - d
-
-        # determine the cut planes
         dim1 = do_cut_color + '1'
         dim2 = do_cut_color + '2'
         dim1_val = getattr(vbox, dim1)
         dim2_val = getattr(vbox, dim2)
+        sums = histo.partial_sums('rgb'.index(do_cut_color), vbox).tolist()
+        total = sums[-1]
+        partialsum = dict(zip(range(dim1_val, dim2_val + 1), sums))
+        lookaheadsum = {}
+        for i, d in partialsum.items():
+            lookaheadsum[i] = total - d
+
+        # determine the cut planes
         for i in range(dim1_val, dim2_val+1):
             if partialsum[i] > (total / 2):
                 vbox1 = vbox.copy
@@ -155,21 +118,24 @@ class MMCQ(object):
         return (None, None)
 
     @staticmethod
-    def quantize(pixels, max_color):
+    def quantize(pixels, max_color, weights=None, sigbits=None):
         """Quantize.
 
         :param pixels: a list of pixel in the form (r, g, b)
         :param max_color: max number of colors
+        :param weights: optional pixel count of each entry of pixels,
+                        when pixels holds the distinct colors of an image
+        :param sigbits: significant bits per component of the histogram
         """
-        if not pixels:
+        if len(pixels) == 0:
             raise Exception('Empty pixels when quantize.')
         if max_color < 2 or max_color > 256:
             raise Exception('Wrong number of max colors when quantize.')
 
-        histo = MMCQ.get_histo(pixels)
+        histo = MMCQ.get_histo(pixels, weights, sigbits)
 
         # check that we aren't below maxcolors already
-        if len(histo) <= max_color:
+        if histo.size <= max_color:
             # generate the new colors from the histo and return
             pass
 
@@ -207,9 +173,8 @@ class MMCQ(object):
 
         # Re-sort by the product of pixel occupancy times the size in
         # color space.
-        pq2 = PQueue(lambda x: x.count * x.volume)
-        while pq.size():
-            pq2.push(pq.pop())
+        pq2 = pq
+        pq2.rekey(lambda x: x.count * x.volume)
 
         # next set - generate the median cuts using the (npix * vol) sorting.
         iter_(pq2, max_color - pq2.size())
@@ -246,25 +211,15 @@ class VBox(object):
 
     @cached_property
     def avg(self):
-        ntot = 0
-        mult = 1 << (8 - MMCQ.SIGBITS)
-        r_sum = 0
-        g_sum = 0
-        b_sum = 0
-        for i in range(self.r1, self.r2 + 1):
-            for j in range(self.g1, self.g2 + 1):
-                for k in range(self.b1, self.b2 + 1):
-                    histoindex = MMCQ.get_color_index(i, j, k)
-                    hval = self.histo.get(histoindex, 0)
-                    ntot += hval
-                    r_sum += hval * (i + 0.5) * mult
-                    g_sum += hval * (j + 0.5) * mult
-                    b_sum += hval * (k + 0.5) * mult
+        mult = 1 << self.histo.rshift
+        ntot, r_sum, g_sum, b_sum = self.histo.box_moments(self)
 
+        # Each cell counts for its center, (i + 0.5) * mult,
+        # the averages are computed in integers to stay exact.
         if ntot:
-            r_avg = int(r_sum / ntot)
-            g_avg = int(g_sum / ntot)
-            b_avg = int(b_sum / ntot)
+            r_avg = (mult * (2 * r_sum + ntot)) // (2 * ntot)
+            g_avg = (mult * (2 * g_sum + ntot)) // (2 * ntot)
+            b_avg = (mult * (2 * b_sum + ntot)) // (2 * ntot)
         else:
             r_avg = int(mult * (self.r1 + self.r2 + 1) / 2)
             g_avg = int(mult * (self.g1 + self.g2 + 1) / 2)
@@ -273,9 +228,9 @@ class VBox(object):
         return r_avg, g_avg, b_avg
 
     def contains(self, pixel):
-        rval = pixel[0] >> MMCQ.RSHIFT
-        gval = pixel[1] >> MMCQ.RSHIFT
-        bval = pixel[2] >> MMCQ.RSHIFT
+        rval = pixel[0] >> self.histo.rshift
+        gval = pixel[1] >> self.histo.rshift
+        bval = pixel[2] >> self.histo.rshift
         return all([
             rval >= self.r1,
             rval <= self.r2,
@@ -287,13 +242,73 @@ class VBox(object):
 
     @cached_property
     def count(self):
-        npix = 0
-        for i in range(self.r1, self.r2 + 1):
-            for j in range(self.g1, self.g2 + 1):
-                for k in range(self.b1, self.b2 + 1):
-                    index = MMCQ.get_color_index(i, j, k)
-                    npix += self.histo.get(index, 0)
-        return npix
+        return self.histo.box_count(self)
+
+
+class Histogram(object):
+    """3d histogram of the quantized color space (2^sigbits cells per axis).
+
+    Cumulative tables of the pixel count and of its first moments
+    (count * cell index on each axis) give the sums over any box
+    in constant time, by inclusion-exclusion on the 8 box corners.
+    """
+    def __init__(self, pixels, weights=None, sigbits=5):
+        self.sigbits = sigbits
+        self.rshift = 8 - sigbits
+        side = 1 << sigbits
+
+        cells = np.asarray(pixels, dtype=np.int64).reshape(-1, 3) >> self.rshift
+        index = (cells[:, 0] << (2 * sigbits)) + (cells[:, 1] << sigbits) + cells[:, 2]
+        if weights is None:
+            counts = np.bincount(index, minlength=side ** 3)
+        else:
+            counts = np.bincount(index, weights=weights, minlength=side ** 3)
+            counts = np.rint(counts).astype(np.int64)
+        self.counts = counts.reshape(side, side, side)
+
+        axis = np.arange(side, dtype=np.int64)
+        self.tables = np.stack([
+            self.counts,
+            self.counts * axis[:, None, None],
+            self.counts * axis[None, :, None],
+            self.counts * axis[None, None, :],
+        ])
+        # tables[t, r + 1, g + 1, b + 1] = sum of the moment t over [0, r] x [0, g] x [0, b]
+        self.tables = np.pad(self.tables, ((0, 0), (1, 0), (1, 0), (1, 0)))
+        for dim in (1, 2, 3):
+            np.cumsum(self.tables, axis=dim, out=self.tables)
+
+    @property
+    def size(self):
+        """number of occupied cells"""
+        return int(np.count_nonzero(self.counts))
+
+    def get(self, index, default=0):
+        r = index >> (2 * self.sigbits)
+        g = (index >> self.sigbits) & ((1 << self.sigbits) - 1)
+        b = index & ((1 << self.sigbits) - 1)
+        return int(self.counts[r, g, b]) or default
+
+    def box_sums(self, r1, r2, g1, g2, b1, b2):
+        """count and moments over the (inclusive) box,
+        bounds can be arrays that broadcast together"""
+        t = self.tables
+        r1, r2, g1, g2, b1, b2 = np.broadcast_arrays(r1, np.add(r2, 1), g1, np.add(g2, 1), b1, np.add(b2, 1))
+        return (t[:, r2, g2, b2] - t[:, r1, g2, b2] - t[:, r2, g1, b2] - t[:, r2, g2, b1]
+                + t[:, r1, g1, b2] + t[:, r1, g2, b1] + t[:, r2, g1, b1] - t[:, r1, g1, b1])
+
+    def box_count(self, vbox):
+        return int(self.box_sums(vbox.r1, vbox.r2, vbox.g1, vbox.g2, vbox.b1, vbox.b2)[0])
+
+    def box_moments(self, vbox):
+        return self.box_sums(vbox.r1, vbox.r2, vbox.g1, vbox.g2, vbox.b1, vbox.b2).tolist()
+
+    def partial_sums(self, axis, vbox):
+        """pixel count of the box cut at each plane along axis (0: r, 1: g, 2: b),
+        from its lower bound up to each plane included"""
+        bounds = [vbox.r1, vbox.r2, vbox.g1, vbox.g2, vbox.b1, vbox.b2]
+        bounds[2 * axis + 1] = np.arange(bounds[2 * axis], bounds[2 * axis + 1] + 1)
+        return self.box_sums(*bounds)[0]
 
 
 class CMap(object):
@@ -314,7 +329,13 @@ class CMap(object):
     def size(self):
         return self.vboxes.size()
 
-    def nearest(self, color):
+    def nearest(self, color, color_space="RGB"):
+        if not is_rgb(color_space):
+            # distances in a perceptual space (see colorspace.COLOR_SPACES)
+            palette = self.palette
+            points = to_color_space([color] + palette, color_space)
+            distances = ((points[1:] - points[0]) ** 2).sum(axis=1)
+            return palette[int(np.argmin(distances))]
         d1 = None
         p_color = None
         for i in range(self.vboxes.size()):
@@ -329,43 +350,77 @@ class CMap(object):
                 p_color = vbox['color']
         return p_color
 
-    def map(self, color):
+    def map(self, color, color_space="RGB"):
         for i in range(self.vboxes.size()):
             vbox = self.vboxes.peek(i)
             if vbox['vbox'].contains(color):
                 return vbox['color']
-        return self.nearest(color)
+        return self.nearest(color, color_space)
+
+    def map_array(self, pixels, lookup="exact", bits_per_gun=4, color_space="RGB"):
+        """Map a whole (N, 3) array of pixels onto the palette colors,
+        either by exact nearest search or through the cached inverse
+        palette of the given bit depth (see mapping.LOOKUP_MODES),
+        the distances being measured in color_space.
+        """
+        palette = np.array(self.palette, dtype=np.int32).reshape(-1, 3)
+        return palette[palette_indices(pixels, palette, lookup, bits_per_gun, color_space)]
 
 
 class PQueue(object):
-    """Simple priority queue."""
+    """Priority queue backed by a binary heap.
+
+    pop() returns the item with the largest key, and among equal keys the
+    most recently pushed one. Keys are computed once, when an item is pushed.
+    """
     def __init__(self, sort_key):
         self.sort_key = sort_key
+        # heap entries are (-key, order, item), order is a tuple of numbers
+        # that sorts the most recently pushed items first (see rekey)
         self.contents = []
-        self._sorted = False
+        self._pushed = 0
+        self._sorted = None
 
     def sort(self):
-        self.contents.sort(key=self.sort_key)
-        self._sorted = True
+        # ascending keys, the order peek(index) walks through
+        if self._sorted is None:
+            self._sorted = [entry[2] for entry in sorted(self.contents, reverse=True)]
+        return self._sorted
 
     def push(self, o):
-        self.contents.append(o)
-        self._sorted = False
+        self._pushed += 1
+        heapq.heappush(self.contents, (-self.sort_key(o), (-1, -self._pushed), o))
+        self._sorted = None
 
     def peek(self, index=None):
-        if not self._sorted:
-            self.sort()
         if index is None:
-            index = len(self.contents) - 1
-        return self.contents[index]
+            return self.contents[0][2]
+        return self.sort()[index]
 
     def pop(self):
-        if not self._sorted:
-            self.sort()
-        return self.contents.pop()
+        self._sorted = None
+        return heapq.heappop(self.contents)[2]
+
+    def rekey(self, sort_key):
+        """Switch to a new sort key, as if the queue had been drained
+        into a new PQueue(sort_key), in O(n).
+
+        Draining would make the pop order the new push order, which breaks
+        the ties between equal new keys: the item that would be popped last
+        wins. Its position comes from the old entry itself, so the new order
+        is (0, old key, old order with each component negated), which sorts
+        backwards from the old pop order. The items pushed afterwards get
+        (-1, -push order), before all of them.
+        """
+        self.sort_key = sort_key
+        self.contents = [(-sort_key(o), (0, -key) + tuple(-value for value in order), o)
+                         for key, order, o in self.contents]
+        self._sorted = None
+        heapq.heapify(self.contents)
 
     def size(self):
         return len(self.contents)
 
     def map(self, f):
-        return list(map(f, self.contents))
+        # in push order
+        return [f(entry[2]) for entry in sorted(self.contents, key=lambda entry: entry[1], reverse=True)]
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+PALETTE_CACHE_VERSION = 1
+
+# Size of the on-disk store, the least recently used palettes are deleted beyond it
+DEFAULT_CACHE_BYTES = 32 << 20
+# An eviction trims the directory to this share of max_bytes, so that the next puts do not evict again
+EVICTION_TARGET = 0.9
+MEMORY_CACHE_SIZE = 64
+
+# One cache per directory and per process, so that the in-memory layer
+# survives from one conversion to the next
+_palette_caches = {}
+
+
+def default_cache_dir():
+    # COLORPAL_CACHE_DIR, or the user cache directory
+    cache_dir = os.environ.get("COLORPAL_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "colorpal")
+
+
+def open_palette_cache(cache_dir=None):
+    cache_dir = os.path.abspath(cache_dir or default_cache_dir())
+    if cache_dir not in _palette_caches:
+        _palette_caches[cache_dir] = PaletteCache(cache_dir)
+    return _palette_caches[cache_dir]
+
+
+def palette_key(colors, counts, params):
+    # Content of the color histogram (see build_color_histogram_from_image)
+    # and quantizer parameters: two images with the same colors share their palette
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps({"version": PALETTE_CACHE_VERSION, "params": params}, sort_keys=True).encode())
+    sha1.update(np.ascontiguousarray(colors, dtype=np.int32).tobytes())
+    if counts is not None:
+        sha1.update(np.ascontiguousarray(counts, dtype=np.int64).tobytes())
+    return sha1.hexdigest()
+
+
+class PaletteCache(object):
+    """Palettes computed by quantize_colors, in memory (LRU) and in a directory
+    that can be shared between sessions and machines. The directory is trimmed
+    to max_bytes, oldest used first. Its size is scanned once, then kept up to
+    date by the puts of this process: the writes of other processes are only
+    seen at the next eviction, which is when the directory is scanned again.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES, memory_size=MEMORY_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_bytes = None  # size of the directory, scanned on the first put
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        # returns the palette, or None
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return [list(color) for color in self.memory[key]]
+
+        palette = None
+        path = self.path(key)
+        try:
+            with open(path, "r") as file:
+                content = json.load(file)
+            if content.get("version") == PALETTE_CACHE_VERSION:
+                palette = content["palette"]
+            # the modification time is the last use, for the eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if palette is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.remember(key, palette)
+        return [list(color) for color in palette]
+
+    def put(self, key, palette):
+        palette = [[int(component) for component in color] for color in palette]
+        self.remember(key, palette)
+
+        # a unique temporary file, then an atomic rename: concurrent writers, processes
+        # or threads of the same process, never see a truncated file
+        path = self.path(key)
+        temporary_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _, size, _ in self.entries())
+            try:
+                replaced_bytes = os.path.getsize(path)
+            except OSError:
+                replaced_bytes = 0
+
+            handle, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+            with os.fdopen(handle, "w") as file:
+                json.dump({"version": PALETTE_CACHE_VERSION, "palette": palette}, file)
+                written_bytes = file.tell()
+            os.replace(temporary_path, path)
+            temporary_path = None
+
+            self.disk_bytes += written_bytes - replaced_bytes
+            if self.disk_bytes > self.max_bytes:
+                self.evict()
+        except OSError:
+            if temporary_path is not None:
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+
+    def remember(self, key, palette):
+        self.memory[key] = tuple(tuple(color) for color in palette)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def entries(self):
+        # [(last use, size, path)] of the palettes on disk
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith(".json"):
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        # delete the least recently used palettes until the directory fits in EVICTION_TARGET * max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.disk_bytes = total
+
+    def clear(self):
+        self.memory.clear()
+        self.disk_bytes = None
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith(".json"):
+                    os.remove(os.path.join(root, filename))
@@ -0,0 +1,155 @@
+import os
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+from PIL import Image
+
+from quantize import progress_callback_stub, remap
+from streaming import dithered_strips, indexed_strips
+
+# Environment variables read by the BLAS / OpenMP runtimes (numpy, scikit-learn)
+THREAD_LIMIT_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                          "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# Below this size, starting the tiles costs more than it saves
+PARALLEL_MIN_PIXELS = 1 << 20
+# Row tiles per worker, so that a slow tile does not hold the others back
+TILES_PER_WORKER = 4
+MIN_TILE_ROWS = 16
+
+# Pool of indexing processes, started on first use and kept for the next images
+_index_pool = None
+_index_pool_workers = 0
+
+
+def limit_threads(threads_per_job):
+    # Each worker process gets its own small share of the cores,
+    # otherwise every KMeans fit would spawn as many threads as there are cores.
+    for variable in THREAD_LIMIT_VARIABLES:
+        os.environ[variable] = str(threads_per_job)
+
+    # the runtimes already loaded in this process need to be told directly
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads_per_job)
+    except ImportError:
+        pass
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def index_pool(workers):
+    # The processes are spawned rather than forked: the viewer runs its conversions
+    # on a thread, and forking a process with threads is not safe.
+    global _index_pool, _index_pool_workers
+    if _index_pool is None or _index_pool_workers != workers:
+        shutdown_index_pool()
+        _index_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                          initializer=limit_threads, initargs=(1,))
+        _index_pool_workers = workers
+    return _index_pool
+
+
+@atexit.register
+def shutdown_index_pool():
+    global _index_pool
+    if _index_pool is not None:
+        _index_pool.shutdown(cancel_futures=True)
+        _index_pool = None
+
+
+def index_rows(source, indices, y0, y1, palette, luma_amplitude, pattern, lookup, bits_per_gun, color_space="RGB"):
+    # Dither (if luma_amplitude > 0) and index the rows y0:y1 of source into indices,
+    # same result as apply_dither_overlay + png_24bit_to_indexed on these rows
+    strips = [(y0, source[y0:y1])]
+    if luma_amplitude > 0.0:
+        strips = dithered_strips(strips, luma_amplitude, pattern)
+    for _, tile in indexed_strips(strips, palette, lookup, bits_per_gun, color_space):
+        indices[y0:y1] = tile
+
+
+def index_tile(source_name, indices_name, width, height, y0, y1, palette, luma_amplitude, pattern, lookup, bits_per_gun,
+               color_space="RGB"):
+    # Worker process: the pixels and indices are shared, only the tile bounds and palette are sent
+    source_memory = shared_memory.SharedMemory(name=source_name)
+    indices_memory = shared_memory.SharedMemory(name=indices_name)
+    try:
+        source = np.ndarray((height, width, 3), dtype=np.uint8, buffer=source_memory.buf)
+        indices = np.ndarray((height, width), dtype=np.uint8, buffer=indices_memory.buf)
+        index_rows(source, indices, y0, y1, palette, luma_amplitude, pattern, lookup, bits_per_gun, color_space)
+        # the views must be gone before the shared memory is closed
+        del source, indices
+    finally:
+        source_memory.close()
+        indices_memory.close()
+    return y1 - y0
+
+
+def row_tiles(height, workers):
+    tile_rows = max(MIN_TILE_ROWS, -(-height // (workers * TILES_PER_WORKER)))
+    return [(y0, min(y0 + tile_rows, height)) for y0 in range(0, height, tile_rows)]
+
+
+def parallel_indices(img, palette, luma_amplitude=0.0, pattern="Checkerboard", lookup="exact", bits_per_gun=4,
+                     workers=None, progress_callback=progress_callback_stub, pb_min=0, pb_max=100, color_space="RGB"):
+    # (h, w) palette indices of img, dithered with the ordered pattern if luma_amplitude > 0,
+    # computed by row tiles in a pool of workers processes
+    workers = workers or default_workers()
+    palette = [list(color) for color in palette]
+    img_data = np.asarray(img.convert("RGB"))
+    height, width, _ = img_data.shape
+
+    if workers <= 1 or width * height < PARALLEL_MIN_PIXELS:
+        indices = np.empty((height, width), dtype=np.uint8)
+        progress_callback(pb_min)
+        index_rows(img_data, indices, 0, height, palette, luma_amplitude, pattern, lookup, bits_per_gun, color_space)
+        progress_callback(pb_max)
+        return indices
+
+    source_memory = shared_memory.SharedMemory(create=True, size=max(1, img_data.nbytes))
+    indices_memory = shared_memory.SharedMemory(create=True, size=max(1, width * height))
+    futures = []
+    try:
+        source = np.ndarray(img_data.shape, dtype=np.uint8, buffer=source_memory.buf)
+        source[:] = img_data
+        del source, img_data
+
+        pool = index_pool(workers)
+        futures = [pool.submit(index_tile, source_memory.name, indices_memory.name, width, height, y0, y1,
+                               palette, luma_amplitude, pattern, lookup, bits_per_gun, color_space)
+                   for y0, y1 in row_tiles(height, workers)]
+        done_rows = 0
+        for future in as_completed(futures):
+            done_rows += future.result()
+            progress_callback(remap(done_rows / height, 0.0, 1.0, pb_min, pb_max))
+
+        shared_indices = np.ndarray((height, width), dtype=np.uint8, buffer=indices_memory.buf)
+        indices = shared_indices.copy()
+        del shared_indices
+        return indices
+    finally:
+        # e.g. a cancelled conversion: no tile may still use the memory once it is released
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        source_memory.close()
+        source_memory.unlink()
+        indices_memory.close()
+        indices_memory.unlink()
+
+
+def parallel_png_24bit_to_indexed(input_img, representative_colors, luma_amplitude=0.0, pattern="Checkerboard",
+                                  lookup="exact", bits_per_gun=4, workers=None,
+                                  progress_callback=progress_callback_stub, pb_min=0, pb_max=100, color_space="RGB"):
+    # apply_dither_overlay + png_24bit_to_indexed, on several cores
+    indices = parallel_indices(input_img, representative_colors, luma_amplitude, pattern, lookup, bits_per_gun,
+                               workers, progress_callback, pb_min, pb_max, color_space)
+    height, width = indices.shape
+    indexed_img = Image.frombuffer("P", (width, height), indices, "raw", "P", 0, 1)
+    indexed_img.putpalette([item for sublist in representative_colors for item in sublist])
+    return indexed_img
@@ -0,0 +1,199 @@
+from quantize import progress_callback_stub, remap, build_color_histogram_from_image, quantize_colors, sort_palette_by_luminance, \
+    apply_dither_overlay, png_24bit_to_indexed, png_24bit_to_indexed_error_diffusion
+from dither import is_error_diffusion
+from raw import export_image_to_raw, RawImageWriter
+from streaming import DEFAULT_STRIP_HEIGHT, image_size, image_strips, strip_color_histogram, dithered_strips, indexed_strips
+from palette_cache import palette_key
+from instrument import Tracer
+from parallel import parallel_png_24bit_to_indexed
+from colorspace import is_rgb
+from auto import DEFAULT_TIME_BUDGET, quantize_colors_auto
+
+
+class ConversionCancelled(Exception):
+    """Raised from a progress callback to abandon a conversion."""
+
+
+class PipelineConfig(object):
+    """Settings of a conversion, from a true color image to an indexed one."""
+    def __init__(self, palette_size=16, method="Kmeans", bits_per_gun=4,
+                 dither_intensity=0.05, dither_pattern="Checkerboard", lookup="exact",
+                 kmeans_sample_budget=None, kmeans_minibatch=False, auto_time_budget=DEFAULT_TIME_BUDGET,
+                 color_space="RGB"):
+        self.palette_size = palette_size
+        self.method = method                      # see quantize_colors
+        self.bits_per_gun = bits_per_gun
+        self.dither_intensity = dither_intensity  # 0.0 disables the dithering
+        self.dither_pattern = dither_pattern      # dither.DITHER_PATTERNS or dither.ERROR_DIFFUSION_METHODS
+        self.lookup = lookup                      # mapping.LOOKUP_MODES
+        self.kmeans_sample_budget = kmeans_sample_budget  # None clusters every distinct color
+        self.kmeans_minibatch = kmeans_minibatch
+        self.auto_time_budget = auto_time_budget  # seconds given to each method in the "Auto" mode
+        self.color_space = color_space            # colorspace.COLOR_SPACES, for the KMeans and the palette lookup
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def quantizer_parameters(self):
+        # the settings the palette depends on (see palette_cache)
+        parameters = {"palette_size": self.palette_size, "method": self.method, "bits_per_gun": self.bits_per_gun,
+                      "kmeans_sample_budget": self.kmeans_sample_budget, "kmeans_minibatch": self.kmeans_minibatch}
+        if not is_rgb(self.color_space):
+            parameters["color_space"] = self.color_space
+        if self.method.lower() == "auto":
+            # a method stopped by the budget may change the winner
+            parameters["auto_time_budget"] = self.auto_time_budget
+        return parameters
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def __repr__(self):
+        return "PipelineConfig(" + ", ".join(f"{key}={value!r}" for key, value in self.to_dict().items()) + ")"
+
+
+class ConversionPipeline(object):
+    """Headless conversion pipeline, shared by the viewer and the batch tool:
+    color extraction -> quantization -> luminance sort -> dither + indexing -> SAFB export
+    Each stage can be called on its own, run() chains them.
+    With a palette_cache.PaletteCache, the quantization of an already seen
+    color histogram is skipped.
+    With an instrument.Tracer, the time spent in each stage is recorded.
+    With several workers, the ordered dither and indexing of large images are
+    spread over that many processes (see parallel.py), and so are the methods
+    tried by the "Auto" quantization (see auto.py).
+    """
+    def __init__(self, config=None, palette_cache=None, tracer=None, workers=1):
+        self.config = config if config is not None else PipelineConfig()
+        self.palette_cache = palette_cache
+        self.tracer = tracer if tracer is not None else Tracer(enabled=False)
+        self.workers = workers
+
+    def extract_colors(self, img, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
+        # distinct colors and their pixel count
+        with self.tracer.stage("extract colors", pixels=img.width * img.height) as counts:
+            colors, pixel_counts = build_color_histogram_from_image(img, progress_callback, pb_min, pb_max)
+            counts["colors"] = len(colors)
+        return colors, pixel_counts
+
+    def quantize(self, colors, counts, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
+        config = self.config
+        with self.tracer.stage("quantize", method=config.method, colors=len(colors)) as stage_counts:
+            key = None
+            if self.palette_cache is not None:
+                key = palette_key(colors, counts, config.quantizer_parameters())
+                palette = self.palette_cache.get(key)
+                stage_counts["cache_hit"] = palette is not None
+                if palette is not None:
+                    stage_counts["palette_size"] = len(palette)
+                    return palette
+
+            kmeans_options = {"sample_budget": config.kmeans_sample_budget, "minibatch": config.kmeans_minibatch,
+                              "color_space": config.color_space}
+            if config.method.lower() == "auto":
+                palette, report = quantize_colors_auto(
+                    colors, counts, config.palette_size, config.bits_per_gun, kmeans_options,
+                    time_budget=config.auto_time_budget, workers=self.workers,
+                    progress_callback=lambda value: progress_callback(remap(value, 0.0, 1.0, pb_min, pb_max)))
+                for method, result in report.items():
+                    if "error" in result:
+                        print(f"Auto: {method} failed after {result['seconds']:.2f} s ({result['error']})")
+                    else:
+                        print(f"Auto: {method} {result['psnr']:.2f} dB in {result['seconds']:.2f} s" + (" <- best" if result.get("winner") else ""))
+                stage_counts["auto_method"] = next(method for method, result in report.items() if result.get("winner"))
+            else:
+                palette = quantize_colors(colors, config.palette_size, config.method, config.bits_per_gun, counts, kmeans_options)
+            stage_counts["palette_size"] = len(palette)
+
+            if key is not None:
+                self.palette_cache.put(key, palette)
+        return palette
+
+    def sort_palette(self, palette):
+        with self.tracer.stage("sort palette", colors=len(palette)):
+            return sort_palette_by_luminance(palette)
+
+    def index(self, img, palette, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
+        # dither + palette indexing, returns a "P" image
+        config = self.config
+        pixels = img.width * img.height
+        pb_mid = (pb_min + pb_max) / 2
+        if config.dither_intensity > 0.0 and is_error_diffusion(config.dither_pattern):
+            # error diffusion picks the palette indices itself
+            with self.tracer.stage("error diffusion", method=config.dither_pattern, lookup=config.lookup, pixels=pixels, colors=len(palette)):
+                return png_24bit_to_indexed_error_diffusion(img, palette, config.dither_pattern, progress_callback, pb_min, pb_max,
+                                                            lookup=config.lookup, bits_per_gun=config.bits_per_gun)
+
+        if self.workers > 1:
+            with self.tracer.stage("dither + index", pattern=config.dither_pattern, lookup=config.lookup, color_space=config.color_space,
+                                   pixels=pixels, colors=len(palette), workers=self.workers):
+                return parallel_png_24bit_to_indexed(img, palette, config.dither_intensity, config.dither_pattern, config.lookup,
+                                                     config.bits_per_gun, self.workers, progress_callback, pb_min, pb_max,
+                                                     config.color_space)
+
+        if config.dither_intensity > 0.0:
+            with self.tracer.stage("dither", pattern=config.dither_pattern, pixels=pixels):
+                img = apply_dither_overlay(img, config.dither_intensity, progress_callback, pb_min, pb_mid, config.dither_pattern)
+        with self.tracer.stage("index", lookup=config.lookup, color_space=config.color_space, pixels=pixels, colors=len(palette)):
+            return png_24bit_to_indexed(img, palette, progress_callback, pb_mid, pb_max, config.lookup, config.bits_per_gun,
+                                        config.color_space)
+
+    def export(self, indexed_img, filename):
+        with self.tracer.stage("export", pixels=indexed_img.width * indexed_img.height):
+            return export_image_to_raw(indexed_img, filename)
+
+    def run(self, img, progress_callback=progress_callback_stub, palette=None, histogram=None):
+        # returns the indexed image and its palette
+        # when a palette is given, the color extraction and quantization are skipped,
+        # histogram: the (colors, counts) of img if already known
+        if palette is None:
+            if histogram is not None:
+                colors, counts = histogram
+            else:
+                colors, counts = self.extract_colors(img, progress_callback, 0, 20)
+
+            progress_callback(30)
+            palette = self.quantize(colors, counts, progress_callback, 30, 40)
+
+        progress_callback(40)
+        palette = self.sort_palette(palette)
+
+        indexed_img = self.index(img, palette, progress_callback, 50, 80)
+
+        progress_callback(90)
+        return indexed_img, palette
+
+    def run_streaming(self, source, filename, progress_callback=progress_callback_stub, palette=None,
+                      strip_height=DEFAULT_STRIP_HEIGHT):
+        # Same conversion as run() + export(), by strips of rows for very large images:
+        # source (a PIL image or a (h, w, 3) array) is read twice, for the color histogram
+        # then for the dither and indexing, and the SAFB file is written as the strips come.
+        # Returns the palette.
+        config = self.config
+        if config.dither_intensity > 0.0 and is_error_diffusion(config.dither_pattern):
+            raise ValueError("Error diffusion is not available in streaming mode")
+        width, height = image_size(source)
+
+        if palette is None:
+            with self.tracer.stage("extract colors", pixels=width * height, strip_height=strip_height) as counts:
+                colors, pixel_counts = strip_color_histogram(image_strips(source, strip_height))
+                counts["colors"] = len(colors)
+
+            progress_callback(30)
+            palette = self.quantize(colors, pixel_counts, progress_callback, 30, 40)
+
+        progress_callback(40)
+        palette = self.sort_palette(palette)
+
+        with self.tracer.stage("dither + index + export", pixels=width * height, strip_height=strip_height):
+            strips = image_strips(source, strip_height)
+            if config.dither_intensity > 0.0:
+                strips = dithered_strips(strips, config.dither_intensity, config.dither_pattern)
+            with RawImageWriter(filename, width, height, palette) as writer:
+                for y0, indices in indexed_strips(strips, palette, config.lookup, config.bits_per_gun, config.color_space):
+                    progress_callback(remap(y0 / height, 0.0, 1.0, 50, 90))
+                    writer.write_rows(indices)
+
+        progress_callback(90)
+        return palette
@@ -1,13 +1,16 @@
 import numpy as np
 from mmcq import MMCQ
+from dither import overlay_in_place, error_diffusion_indices
+from instrument import add_count
+from colorspace import is_rgb, to_color_space, from_color_space
+from mapping import palette_to_array, duplicate_palette_remap, rows_per_block, nearest_palette_indices, binned_palette_indices
 # from operator import itemgetter
 # from collections import defaultdict
-from sklearn.cluster import KMeans
-from collections import Counter
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from PIL import Image
 
 
-def progress_callback_stub(v,a,b,c,d):
+def progress_callback_stub(v, *args):
     pass
 
 def remap(value, a, b, c, d):
@@ -23,60 +26,94 @@ def sort_palette_by_luminance(palette):
     return sorted(palette, key=luminance)
 
 
-def build_color_list_from_image(img, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
-    if img is not None:
-        colors = []
-        for y in range(img.height):
-            progress_callback(remap(y / img.height, 0.0, 1.0, pb_min, pb_max))
-            for x in range(img.width):
-                color = img.getpixel((x, y))
-                # r = (color[0] // 16) * 16
-                # g = (color[1] // 16) * 16
-                # b = (color[2] // 16) * 16
-                # if not([r, g, b] in colors):
-                #     colors.append([r, g, b])
-                colors.append([color[0], color[1], color[2]])
-
-        print("True Color Palette: " + str(len(colors)) + " colors found.")
-        return colors
+def pack_colors(colors):
+    # (N, 3) colors -> (N,) 24 bits keys, 0xRRGGBB
+    colors = np.asarray(colors).reshape(-1, 3).astype(np.uint32)
+    return (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
 
 
-def overlay_formula(a, b):
-    return np.where(a <= 0.5, 2 * a * b, 1 - 2 * (1 - a) * (1 - b))
+def unpack_colors(keys):
+    keys = np.asarray(keys, dtype=np.uint32)
+    return np.stack([(keys >> 16) & 0xFF, (keys >> 8) & 0xFF, keys & 0xFF], axis=1).astype(np.int32)
 
 
-def apply_dither_overlay(img, luma_amplitude=0.05, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
+def build_color_histogram_from_image(img, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
+    # Returns the distinct colors of the image (N, 3) along with their pixel count (N,)
+    if img is not None:
+        progress_callback(pb_min)
+        img_data = np.asarray(img.convert("RGB"))
+        keys, counts = np.unique(pack_colors(img_data), return_counts=True)
+        progress_callback(pb_max)
+
+        print("True Color Palette: " + str(len(keys)) + " colors found.")
+        return unpack_colors(keys), counts
+
+
+# Distinct colors of the histograms waiting to be merged (see accumulate_key_counts)
+HISTOGRAM_MERGE_ENTRIES = 1 << 20
+
+
+def merge_key_counts(histograms):
+    # [(24 bits keys, counts)] -> (keys, counts), each key once
+    keys = np.concatenate([keys for keys, _ in histograms])
+    counts = np.concatenate([np.asarray(counts, dtype=np.int64) for _, counts in histograms])
+    merged_keys, inverse = np.unique(keys, return_inverse=True)
+    merged_counts = np.zeros(len(merged_keys), dtype=np.int64)
+    np.add.at(merged_counts, inverse, counts)
+    return merged_keys, merged_counts
+
+
+def accumulate_key_counts(histograms, merge_entries=HISTOGRAM_MERGE_ENTRIES):
+    # Merge an iterable of (keys, counts) histograms as they come: they wait until
+    # they hold merge_entries keys, then are merged in one go, instead of merging
+    # the whole accumulated histogram again for each new one. None if there is none.
+    pending = []
+    pending_entries = 0
+    for keys, counts in histograms:
+        pending.append((keys, counts))
+        pending_entries += len(keys)
+        if pending_entries >= merge_entries:
+            pending = [merge_key_counts(pending)]
+            pending_entries = len(pending[0][0])
+
+    if not pending:
+        return None
+    return merge_key_counts(pending)
+
+
+def apply_dither_overlay(img, luma_amplitude=0.05, progress_callback=progress_callback_stub, pb_min=0, pb_max=100, pattern="Checkerboard"):
+    # pattern: one of dither.DITHER_PATTERNS
+    progress_callback(pb_min)
     img_rgb = img.convert("RGB")  # Convertir l'image en RGB
-    img_data = np.array(img_rgb, dtype=np.float32) / 255
-    h, w, _ = img_data.shape
-
-    overlay_color_even = np.array([(1.0 - luma_amplitude) / 2.0] * 3, dtype=np.float32)
-    overlay_color_odd = np.array([(1.0 + luma_amplitude) / 2.0] * 3, dtype=np.float32)
+    img_data = np.asarray(img_rgb, dtype=np.float32)
+    img_data /= 255
 
-    for y in range(h):
-        progress_callback(remap(y / h, 0.0, 1.0, pb_min, pb_max))
-        for x in range(w):
-            if (x + y) % 2 == 0:
-                img_data[y, x] = overlay_formula(img_data[y, x], overlay_color_even)
-            else:
-                img_data[y, x] = overlay_formula(img_data[y, x], overlay_color_odd)
+    overlay_in_place(img_data, luma_amplitude, pattern)
 
-    return Image.fromarray(np.uint8(img_data * 255))
+    img_data *= 255
+    progress_callback(pb_max)
+    return Image.fromarray(img_data.astype(np.uint8))
 
 
-def quantize_colors(colors, n_colors=16, method="kmeans", bits_per_gun=4):
+def quantize_colors(colors, n_colors=16, method="kmeans", bits_per_gun=4, weights=None, kmeans_options=None):
+    # colors can be a list of pixels, or the distinct colors of an image
+    # along with their pixel count in weights (see build_color_histogram_from_image)
+    # kmeans_options: extra arguments of quantize_colors_kmeans (sample_budget, minibatch, color_space)
+    kmeans_options = kmeans_options or {}
     if method.lower() == "kmeans":
-        return quantize_colors_kmeans(colors, n_colors, bits_per_gun)
+        return quantize_colors_kmeans(colors, n_colors, bits_per_gun, weights, **kmeans_options)
     if method.lower() == "median cut":
-        return quantize_colors_median_cut(colors, n_colors, bits_per_gun)
+        return quantize_colors_median_cut(colors, n_colors, bits_per_gun, weights)
     if method.lower() == "popularity":
-        return quantize_colors_popularity(colors, n_colors, bits_per_gun)
+        return quantize_colors_popularity(colors, n_colors, bits_per_gun, weights)
     if method.lower() == "mmcq":
-        return quantize_colors_mmcq(colors, n_colors, bits_per_gun)
+        return quantize_colors_mmcq(colors, n_colors, bits_per_gun, weights)
     if method.lower() == "kmeans + mmcq":
-        return quantize_colors_kmeans_mmcq(colors, n_colors, bits_per_gun)
+        return quantize_colors_kmeans_mmcq(colors, n_colors, bits_per_gun, weights, kmeans_options)
     if method.lower() == "kmeans + median cut":
-        return quantize_colors_kmeans_median_cut(colors, n_colors, bits_per_gun)
+        return quantize_colors_kmeans_median_cut(colors, n_colors, bits_per_gun, weights, kmeans_options)
+    if method.lower() == "grid kmeans":
+        return quantize_colors_grid(colors, n_colors, bits_per_gun, weights)
 
 
 def halve_palette(colors, num_clusters=None):
@@ -87,6 +124,10 @@ def halve_palette(colors, num_clusters=None):
     if num_clusters is None:
         num_clusters = len(colors) // 2
 
+    # Nothing to merge in a palette of a single color
+    if num_clusters < 1:
+        return colors.tolist()
+
     # Fit a k-means model
     kmeans = KMeans(n_clusters=num_clusters, random_state=0).fit(colors)
 
@@ -97,19 +138,19 @@ def halve_palette(colors, num_clusters=None):
     return new_colors.tolist()
 
 
-def quantize_colors_kmeans_median_cut(colors, n_colors, bits_per_gun=4):
-    kmeans_palette = quantize_colors_kmeans(colors, n_colors, bits_per_gun)
-    median_palette = quantize_colors_median_cut(colors, n_colors, bits_per_gun)
+def quantize_colors_kmeans_median_cut(colors, n_colors, bits_per_gun=4, weights=None, kmeans_options=None):
+    kmeans_palette = quantize_colors_kmeans(colors, n_colors, bits_per_gun, weights, **(kmeans_options or {}))
+    median_palette = quantize_colors_median_cut(colors, n_colors, bits_per_gun, weights)
     return halve_palette(kmeans_palette + median_palette)
 
 
-def quantize_colors_kmeans_mmcq(colors, n_colors=16, bits_per_gun=4):
-    kmeans_palette = quantize_colors_kmeans(colors, n_colors, bits_per_gun)
-    mmcq_palette = quantize_colors_mmcq(colors, n_colors, bits_per_gun)
+def quantize_colors_kmeans_mmcq(colors, n_colors=16, bits_per_gun=4, weights=None, kmeans_options=None):
+    kmeans_palette = quantize_colors_kmeans(colors, n_colors, bits_per_gun, weights, **(kmeans_options or {}))
+    mmcq_palette = quantize_colors_mmcq(colors, n_colors, bits_per_gun, weights)
     return halve_palette(kmeans_palette + mmcq_palette)
 
 
-def quantize_colors_mmcq(colors, n_colors=16, bits_per_gun=4):
+def quantize_colors_mmcq(colors, n_colors=16, bits_per_gun=4, weights=None):
     # how many shades per component ?
     color_shades = (1 << (8 - bits_per_gun)) + 1
 
@@ -124,7 +165,7 @@ def quantize_colors_mmcq(colors, n_colors=16, bits_per_gun=4):
     requested_colors = n_colors * 2
     while len(representative_colors) < n_colors:
         # Select the most common colors
-        representative_colors = np.array(MMCQ.quantize(colors, requested_colors).palette)
+        representative_colors = np.array(MMCQ.quantize(colors, requested_colors, weights).palette)
 
         # Apply the same quantization
         representative_colors = np.round(np.array(representative_colors) / color_shades) * color_shades
@@ -137,12 +178,13 @@ def quantize_colors_mmcq(colors, n_colors=16, bits_per_gun=4):
 
         requested_colors += 1
 
+    add_count("mmcq_retries", requested_colors - n_colors * 2 - 1)
     representative_colors = halve_palette(representative_colors)
 
     return representative_colors
 
 
-def quantize_colors_popularity(colors, n_colors=16, bits_per_gun=4):
+def quantize_colors_popularity(colors, n_colors=16, bits_per_gun=4, weights=None):
     # how many shades per component ?
     color_shades = (1 << (8 - bits_per_gun)) + 1
 
@@ -151,20 +193,31 @@ def quantize_colors_popularity(colors, n_colors=16, bits_per_gun=4):
 
     n_colors *= 2
 
-    # We'll count the colors using a Counter, then select the most common ones
-    counter = Counter(map(tuple, colors))
+    if weights is None:
+        weights = np.ones(len(colors), dtype=np.int64)
+
+    # Total weight of each distinct color (colors may hold the same color several times),
+    # the colors being kept in their order of first appearance
+    _, first_index, inverse = np.unique(pack_colors(colors), return_index=True, return_inverse=True)
+    totals = np.zeros(len(first_index), dtype=np.int64)
+    np.add.at(totals, inverse, np.asarray(weights, dtype=np.int64))
+    appearance = np.argsort(first_index, kind="stable")
+    distinct_colors = colors[first_index[appearance]]
+    # most common first, the first seen first among equal counts
+    distinct_colors = distinct_colors[np.argsort(-totals[appearance], kind="stable")]
 
     # Initialize the list of representative colors
     representative_colors = []
 
-    # Same loop as before, to handle possible color duplication due to quantization
-    requested_colors = n_colors
-    while len(representative_colors) < n_colors:
+    # Same loop as before, to handle possible color duplication due to quantization,
+    # until every distinct color is used
+    requested_colors = first_request = min(n_colors, len(distinct_colors))
+    while len(representative_colors) < n_colors and requested_colors <= len(distinct_colors):
         # Select the most common colors
-        representative_colors = [color for color, _ in counter.most_common(requested_colors)]
+        representative_colors = distinct_colors[:requested_colors]
 
         # Apply the same quantization
-        representative_colors = np.round(np.array(representative_colors) / color_shades) * color_shades
+        representative_colors = np.round(representative_colors / color_shades) * color_shades
         representative_colors = representative_colors.clip(0, 255)
         representative_colors = representative_colors.astype(int)
 
@@ -174,17 +227,28 @@ def quantize_colors_popularity(colors, n_colors=16, bits_per_gun=4):
 
         requested_colors += 1
 
+    add_count("popularity_retries", max(requested_colors - first_request - 1, 0))
     return halve_palette(representative_colors)
 
-def quantize_colors_median_cut(colors, n_colors=16, bits_per_gun=4):
+def quantize_colors_median_cut(colors, n_colors=16, bits_per_gun=4, weights=None):
     # how many shades per component ?
     color_shades = (1 << (8 - bits_per_gun)) + 1
 
     # Normalize the colors
     colors = np.array(colors, dtype=np.int32)
+    if weights is None:
+        weights = np.ones(len(colors), dtype=np.int64)
+    weights = np.asarray(weights)
 
     # Initialize color_buckets with all colors in one bucket
-    color_buckets = [colors.tolist()]
+    # (each bucket holds the indices of its colors)
+    color_buckets = [np.arange(len(colors))]
+
+    def bucket_representatives():
+        # (weighted) mean of each bucket, snapped to the grid and de-duplicated
+        representatives = [np.average(colors[bucket], axis=0, weights=weights[bucket]) for bucket in color_buckets if len(bucket)]
+        representatives = np.round(np.array(representatives).reshape(-1, 3) / color_shades) * color_shades
+        return np.unique(representatives.clip(0, 255).astype(int), axis=0).tolist()
 
     # Keep track of the representative colors after quantization and de-duplication
     representative_colors = []
@@ -192,35 +256,37 @@ def quantize_colors_median_cut(colors, n_colors=16, bits_per_gun=4):
     # Split the buckets until we have at least n_colors unique representative colors
     while len(representative_colors) < n_colors:
         # Select the bucket to split
-        # In this case, we choose the bucket with the most colors
-        largest_bucket_index = max(range(len(color_buckets)), key=lambda index: len(color_buckets[index]))
-        largest_bucket = np.array(color_buckets[largest_bucket_index])
+        # In this case, we choose the bucket with the most pixels
+        splittable_buckets = [index for index in range(len(color_buckets)) if len(color_buckets[index]) > 1]
+        if not splittable_buckets:
+            # e.g. a single color: the buckets are kept as they are
+            representative_colors = bucket_representatives()
+            break
+        largest_bucket_index = max(splittable_buckets, key=lambda index: weights[color_buckets[index]].sum())
+        largest_bucket = color_buckets[largest_bucket_index]
+        bucket_colors = colors[largest_bucket]
+        bucket_weights = weights[largest_bucket]
 
         # Find the color dimension with the greatest standard deviation in the bucket
-        std_dev = np.std(largest_bucket, axis=0)
+        mean = np.average(bucket_colors, axis=0, weights=bucket_weights)
+        std_dev = np.sqrt(np.average((bucket_colors - mean) ** 2, axis=0, weights=bucket_weights))
         highest_var_dim = np.argmax(std_dev)
 
         # Sort the selected bucket along the color dimension with the greatest standard deviation
-        largest_bucket = largest_bucket[largest_bucket[:,highest_var_dim].argsort()]
+        order = bucket_colors[:, highest_var_dim].argsort()
+        largest_bucket = largest_bucket[order]
 
-        # Find the median color along the color dimension with the greatest standard deviation
-        median_index = len(largest_bucket) // 2
+        # Find the (weighted) median color along the color dimension with the greatest standard deviation
+        cumulative_weights = np.cumsum(bucket_weights[order])
+        median_index = np.searchsorted(cumulative_weights, cumulative_weights[-1] / 2, side="right")
+        median_index = min(max(median_index, 1), len(largest_bucket) - 1)
 
         # Split the bucket into two around the median color
-        color_buckets[largest_bucket_index] = largest_bucket[:median_index].tolist()
-        color_buckets.append(largest_bucket[median_index:].tolist())
-
-        # Calculate the representative colors
-        representative_colors_temp = [np.mean(np.array(bucket), axis=0) for bucket in color_buckets]
+        color_buckets[largest_bucket_index] = largest_bucket[:median_index]
+        color_buckets.append(largest_bucket[median_index:])
 
-        # Apply the same quantization
-        representative_colors_temp = np.round(np.array(representative_colors_temp) / color_shades) * color_shades
-        representative_colors_temp = representative_colors_temp.clip(0, 255)
-        representative_colors_temp = representative_colors_temp.astype(int)
-
-        # Remove duplicates
-        representative_colors = np.unique(representative_colors_temp, axis=0)
-        representative_colors = representative_colors.tolist()
+        # Calculate the representative colors, with the same quantization, without duplicates
+        representative_colors = bucket_representatives()
 
     return representative_colors
 
@@ -236,25 +302,70 @@ def shift_bits_per_component(colors, bits):
     return colors_out
         
 
-def quantize_colors_kmeans(colors, n_colors=16, bits_per_gun=4):
+def kmeans_coreset(colors, weights=None, sample_budget=4096, seed=42):
+    # Weighted random subsample of at most sample_budget entries:
+    # entries are drawn with a probability proportional to their weight,
+    # and weighted by the number of times they were drawn.
+    if len(colors) <= sample_budget:
+        return colors, weights
+    if weights is None:
+        weights = np.ones(len(colors), dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(colors), size=sample_budget, p=weights / weights.sum())
+    picked, counts = np.unique(picks, return_counts=True)
+    return colors[picked], counts
+
+
+def worst_fitted_color(colors, weights, kmeans):
+    # The color that contributes the most to the inertia of the clustering,
+    # a good seed for an additional cluster
+    residuals = ((colors - kmeans.cluster_centers_[kmeans.labels_]) ** 2).sum(axis=1)
+    if weights is not None:
+        residuals = residuals * weights
+    return colors[np.argmax(residuals)]
+
+
+def quantize_colors_kmeans(colors, n_colors=16, bits_per_gun=4, weights=None, sample_budget=None, minibatch=False,
+                           color_space="RGB"):
+    # sample_budget: cluster a weighted subsample of at most this many colors (see kmeans_coreset)
+    # minibatch: use MiniBatchKMeans instead of KMeans
+    # color_space: space in which the colors are clustered (see colorspace.COLOR_SPACES)
     # how many shades per component ?
     color_shades = (1 << (8 - bits_per_gun)) + 1
 
     # Normalize the colors
-    colors = np.array(colors, dtype=np.float64) / 255
+    if is_rgb(color_space):
+        colors = np.array(colors, dtype=np.float64) / 255
+    else:
+        colors = to_color_space(colors, color_space).astype(np.float64)
+    if sample_budget is not None:
+        colors, weights = kmeans_coreset(colors, weights, sample_budget)
 
     # Let's start with the amount of colors that the user wants
-    requested_colors = n_colors
+    requested_colors = first_request = min(n_colors, len(colors))
     representative_colors = []
+    init_centers = None
 
     # Because of the quantization (RGB888 -> RGB444)
     # some colors might be duplicated once result of the kmeans
     # was quantized.
-    # In this case, we increase the target and start again.
-    while len(representative_colors) < n_colors:
+    # In this case, we increase the target and start again,
+    # from the previous centers plus the worst fitted color.
+    while len(representative_colors) < n_colors and requested_colors <= len(colors):
         # print("requested_colors = " + str(requested_colors))
-        kmeans = KMeans(n_clusters=requested_colors, random_state=42).fit(colors)
-        representative_colors = kmeans.cluster_centers_ * 255
+        model = MiniBatchKMeans if minibatch else KMeans
+        if init_centers is None:
+            kmeans = model(n_clusters=requested_colors, random_state=42)
+        else:
+            kmeans = model(n_clusters=requested_colors, init=init_centers, n_init=1, random_state=42)
+        kmeans.fit(colors, sample_weight=weights)
+
+        if is_rgb(color_space):
+            representative_colors = kmeans.cluster_centers_ * 255
+        else:
+            representative_colors = from_color_space(kmeans.cluster_centers_, color_space)
         representative_colors = np.round(representative_colors / color_shades) * color_shades
         representative_colors = representative_colors.clip(0, 255)
         representative_colors = representative_colors.astype(int)
@@ -262,36 +373,166 @@ def quantize_colors_kmeans(colors, n_colors=16, bits_per_gun=4):
         representative_colors = representative_colors.tolist()
 
         requested_colors += 1
-    
+        init_centers = np.vstack([kmeans.cluster_centers_, worst_fitted_color(colors, weights, kmeans)])
+
+    add_count("kmeans_retries", max(requested_colors - first_request - 1, 0))
     return representative_colors
 
 
-def png_24bit_to_indexed(input_img, representative_colors, progress_callback=progress_callback_stub, pb_min=0, pb_max=100):
-    img = input_img
+def snap_to_grid(colors, bits_per_gun=4):
+    # Same rounding as the other quantizers, to the closest of the target depth shades
+    color_shades = (1 << (8 - bits_per_gun)) + 1
+    colors = np.round(np.asarray(colors, dtype=np.float64) / color_shades) * color_shades
+    return colors.clip(0, 255).astype(np.int32)
+
+
+def distinct_grid_points(centers, priorities, cells, bits_per_gun=4):
+    # Snap the centers to the grid, the heaviest clusters first.
+    # When its grid point is already taken, a center goes to the closest free occupied cell,
+    # so that the result never holds the same color twice.
+    snapped = snap_to_grid(centers, bits_per_gun)
+    cell_index = {tuple(cell): index for index, cell in enumerate(cells.tolist())}
+    free = np.ones(len(cells), dtype=bool)
+    taken = set()
+    for k in np.argsort(-priorities, kind="stable"):
+        point = tuple(snapped[k].tolist())
+        if point in taken:
+            candidates = np.flatnonzero(free)
+            distances = ((cells[candidates] - centers[k]) ** 2).sum(axis=1)
+            point = tuple(cells[candidates[np.argmin(distances)]].tolist())
+            snapped[k] = point
+        taken.add(point)
+        if point in cell_index:
+            free[cell_index[point]] = False
+    return snapped
+
+
+def quantize_colors_grid(colors, n_colors=16, bits_per_gun=4, weights=None, max_iterations=20, seed=42):
+    # Weighted k-means over the occupied cells of the target depth grid
+    # (at most 4096 of them in RGB444), whose centers are moved to distinct grid
+    # points after each update: n_colors distinct colors in a single run,
+    # without the quantize / deduplicate / retry loop of the other methods.
+    colors = np.array(colors, dtype=np.int32).reshape(-1, 3)
+    if weights is None:
+        weights = np.ones(len(colors), dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Occupied cells, their pixel count and the mean color of their pixels
+    cell_keys, inverse = np.unique(pack_colors(snap_to_grid(colors, bits_per_gun)), return_inverse=True)
+    cells = unpack_colors(cell_keys)
+    inverse = inverse.ravel()
+    cell_weights = np.bincount(inverse, weights, minlength=len(cells))
+    cell_sums = np.stack([np.bincount(inverse, weights * colors[:, c], minlength=len(cells)) for c in range(3)], axis=1)
+    cell_means = np.where(cell_weights[:, None] > 0, cell_sums / np.maximum(cell_weights, 1e-12)[:, None], cells)
+
+    if len(cells) <= n_colors:
+        return cells.tolist()
+
+    # k-means++ seeding on the cells: the centers start on distinct grid points
+    rng = np.random.default_rng(seed)
+    total = cell_weights.sum()
+    first = rng.choice(len(cells), p=cell_weights / total) if total > 0 else 0
+    seeds = [first]
+    distances = ((cell_means - cell_means[first]) ** 2).sum(axis=1)
+    for _ in range(1, n_colors):
+        scores = cell_weights * distances
+        scores[seeds] = 0
+        if scores.sum() > 0:
+            seed_index = rng.choice(len(cells), p=scores / scores.sum())
+        else:
+            seed_index = np.flatnonzero(np.isin(np.arange(len(cells)), seeds, invert=True))[0]
+        seeds.append(seed_index)
+        distances = np.minimum(distances, ((cell_means - cell_means[seed_index]) ** 2).sum(axis=1))
+    centers = cells[seeds]
+
+    for _ in range(max_iterations):
+        add_count("grid_iterations")
+        distances = ((cell_means[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = np.argmin(distances, axis=1)
+        cluster_weights = np.bincount(labels, cell_weights, minlength=n_colors)
+        cluster_sums = np.stack([np.bincount(labels, cell_sums[:, c], minlength=n_colors) for c in range(3)], axis=1)
+        centroids = centers.astype(np.float64)
+        filled = cluster_weights > 0
+        centroids[filled] = cluster_sums[filled] / cluster_weights[filled, None]
+
+        # an empty cluster takes over the worst fitted cell
+        residuals = cell_weights * distances[np.arange(len(cells)), labels]
+        for k in np.flatnonzero(~filled):
+            worst = np.argmax(residuals)
+            centroids[k] = cell_means[worst]
+            residuals[worst] = 0
+
+        new_centers = distinct_grid_points(centroids, cluster_weights, cells, bits_per_gun)
+        if np.array_equal(new_centers, centers):
+            break
+        centers = new_centers
+
+    return np.unique(centers, axis=0).tolist()
+
+
+def png_24bit_to_indexed(input_img, representative_colors, progress_callback=progress_callback_stub, pb_min=0, pb_max=100, lookup="exact", bits_per_gun=4,
+                         color_space="RGB"):
+    img = input_img.convert("RGB")
 
     # Extract the data from the image
-    img_data = np.array(img)
-    colors = img_data.reshape(-1, 3).tolist()
+    img_data = np.asarray(img)
+    height, width, _ = img_data.shape
+
+    palette = palette_to_array(representative_colors)
 
-    # Build a dictionnary to map the colors onto the image
-    color_to_index = {tuple(color): idx for idx, color in enumerate(representative_colors)}
+    # "exact" searches the closest palette color for every 24 bits pixel,
+    # "binned" goes through the cached inverse palette of the target bit depth.
+    # Distances are measured in color_space (see colorspace.COLOR_SPACES).
+    if lookup == "exact":
+        palette_remap = duplicate_palette_remap(palette)
+        block_height = rows_per_block(width, len(palette))
+
+        def map_block(block):
+            return palette_remap[nearest_palette_indices(block, palette, color_space)]
+    elif lookup == "binned":
+        block_height = rows_per_block(width, 1)
+
+        def map_block(block):
+            return binned_palette_indices(block, palette, bits_per_gun, color_space)
+    else:
+        raise ValueError("Unknown lookup mode: " + str(lookup))
 
     # Create an indexed color buffer with the indexed palette
-    indexed_img = Image.new("P", img.size)
-    indexed_img.putpalette([item for sublist in representative_colors for item in sublist])
+    indexed_data = np.empty((height, width), dtype=np.uint8)
 
-    # Fill in the buffer by writting each pixel
+    # Fill in the buffer by blocks of rows,
     # using the closest color found in the index palette
-    for y in range(img_data.shape[0]):
-        progress_callback(remap(y / img_data.shape[0], 0.0, 1.0, pb_min, pb_max))
-        for x in range(img_data.shape[1]):
-            color = tuple(img_data[y, x])
-            closest_color = min(representative_colors, key=lambda c: sum((c_i - color_i) ** 2 for c_i, color_i in zip(c, color)))
-            indexed_img.putpixel((x, y), color_to_index[tuple(closest_color)])
+    for y in range(0, height, block_height):
+        progress_callback(remap(y / height, 0.0, 1.0, pb_min, pb_max))
+        block = img_data[y:y + block_height].reshape(-1, 3)
+        indexed_data[y:y + block_height] = map_block(block).reshape(-1, width)
+
+    indexed_img = Image.frombuffer("P", (width, height), indexed_data, "raw", "P", 0, 1)
+    indexed_img.putpalette([item for sublist in representative_colors for item in sublist])
 
     # Return the indexed image
     return indexed_img
 
+def png_24bit_to_indexed_error_diffusion(input_img, representative_colors, method="Floyd-Steinberg", progress_callback=progress_callback_stub, pb_min=0, pb_max=100, serpentine=True, strength=1.0,
+                                         lookup="exact", bits_per_gun=4):
+    # Same as png_24bit_to_indexed, with error diffusion dithering (see dither.ERROR_DIFFUSION_METHODS)
+    # done while the palette indices are chosen, in a single sweep of the image.
+    img_data = np.asarray(input_img.convert("RGB"))
+    height, width, _ = img_data.shape
+    progress_step = max(1, height // 100)
+
+    def row_callback(y, h):
+        if y % progress_step == 0:
+            progress_callback(remap(y / h, 0.0, 1.0, pb_min, pb_max))
+
+    indexed_data = error_diffusion_indices(img_data, representative_colors, method, serpentine, strength, row_callback,
+                                           lookup, bits_per_gun)
+
+    indexed_img = Image.frombuffer("P", (width, height), indexed_data, "raw", "P", 0, 1)
+    indexed_img.putpalette([item for sublist in representative_colors for item in sublist])
+
+    return indexed_img
+
 # # Exemple d'utilisation avec les informations de l'image
 # width = 320
 # height = 200
@@ -1,3 +1,6 @@
+import os
+import mmap
+import numpy as np
 from PIL import Image
 import struct
 
@@ -9,97 +12,195 @@ def convert_color_to_rgb444(color):
     return (r << 8) | (g << 4) | b
 
 
-def export_image_to_raw(image, filename):
-    width, height = image.size
+def convert_palette_to_rgb444(palette):
+    palette = np.asarray(palette, dtype=np.uint16).reshape(-1, 3)
+    r = (palette[:, 0] >> 4) & 0xF
+    g = (palette[:, 1] >> 4) & 0xF
+    b = (palette[:, 2] >> 4) & 0xF
+    return (r << 8) | (g << 4) | b
+
+
+def raw_row_bytes(width):
+    # 2 pixels per byte, odd widths are padded with a last index 0 pixel
+    return (width + 1) // 2
+
+
+def pack_indices(indices):
+    # (h, w) palette indices -> (h, raw_row_bytes(w)) bytes, even pixel in the high nibble
+    indices = np.asarray(indices)
+    if indices.size and indices.max() > 0xF:
+        raise ValueError("SAFB images are limited to 16 colors, found index " + str(indices.max()))
+    indices = indices.astype(np.uint8)
+    if indices.shape[1] % 2:
+        indices = np.pad(indices, ((0, 0), (0, 1)))
+    return (indices[:, 0::2] << 4) | indices[:, 1::2]
+
+
+def export_image_to_raw(image, filename, palette=None):
+    # image: a PIL "P" image, or a (h, w) array of palette indices along with its palette
+    if isinstance(image, np.ndarray):
+        indices = image
+        if palette is None:
+            raise ValueError("A palette is required to export an array of indices")
+    else:
+        indices = np.asarray(image)
+        palette = [color[:3] for color in image.palette.colors]
+    height, width = indices.shape
 
-    # export image
+    # export image, in a single write
     with open(filename, "wb") as file:
-        pixels = image.load()
-
-        # image width, height, palette size
-        file.write(b"SAFB") # 4 bytes for the SAFB (Safar Bitmap) header
-        file.write(width.to_bytes(2, byteorder="big")) # 2 bytes for the image width (in pixels)
-        file.write(height.to_bytes(2, byteorder="big")) # 2 bytes for the image height (in pixels)
-        file.write(len(image.palette.colors).to_bytes(2, byteorder="big")) # 2 bytes for the palette size
-
-        # image data
-        file.write(b"DATA") # 4 bytes for the data header
-        for row in range(height):
-            for col in range(width // 2):
-                even_index = pixels[col * 2, row]
-                odd_index = pixels[col * 2 + 1, row]
-                byte = (even_index << 4) | odd_index
-                file.write(byte.to_bytes(1, byteorder="big")) # 2 pixels per byte
-
-        # palette
-        file.write(b"PAL4") # 4 bytes for the palette header
-        for color in image.palette.colors:
-            rgb444 = convert_color_to_rgb444(color)
-            file.write(rgb444.to_bytes(2, byteorder="big")) # 2 bytes per color
+        file.write(b"".join([
+            raw_header(width, height, len(palette)),
+            b"DATA", # 4 bytes for the data header
+            pack_indices(indices).tobytes(), # 2 pixels per byte
+            raw_palette_block(palette),
+        ]))
 
     # debug
     return load_raw_image(filename)
     # return None
 
-# from PIL import Image
-def load_raw_image(filename):
-    width = height = -1
-    palette_size = -1
-    palette_data = None
-    with open(filename, "rb") as file:
-        # check if this is a Safar Bitmap file (SAFB)
-        file_header = file.read(4)
-        if file_header == b"SAFB":
-            bin_width = file.read(2)
-            width = struct.unpack('>H', bin_width)[0]
-            bin_height = file.read(2)
-            height = struct.unpack('>H', bin_height)[0]
-            bin_palette_size = file.read(2)
-            palette_size = struct.unpack('>H', bin_palette_size)[0]
-
-            # check if the bitmap data block follows
-            file_header = file.read(4)
-            if file_header == b"DATA":
-                color_data = file.read(width * height // 2)
-
-                # check if the palette data block follows
-                file_header = file.read(4)
-                if file_header == b"PAL4":
-                    palette_data = file.read(palette_size * 2) # image_data[width * height // 2:]
-                else:
-                    return None
-            else:
-                return None
+
+def raw_header(width, height, palette_size):
+    # image width, height, palette size
+    header = b"SAFB" # 4 bytes for the SAFB (Safar Bitmap) header
+    header += struct.pack(">HHH", width, height, palette_size) # 2 bytes each for the image width, height (in pixels) and the palette size
+    return header
+
+
+def raw_palette_block(palette):
+    return (b"PAL4" # 4 bytes for the palette header
+            + convert_palette_to_rgb444(palette).astype(">u2").tobytes()) # 2 bytes per color
+
+
+class RawImageWriter(object):
+    """Writes a SAFB file by strips of rows: the header and the start of the
+    DATA block when opened, the rows as they come, the palette block when closed.
+    A file left incomplete by an error is deleted.
+    """
+    def __init__(self, filename, width, height, palette):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.rows_written = 0
+        self.file = open(filename, "wb")
+        self.file.write(raw_header(width, height, len(palette)) + b"DATA")
+
+    def write_rows(self, indices):
+        # (rows, width) palette indices, following the rows already written
+        rows, width = indices.shape
+        if width != self.width or self.rows_written + rows > self.height:
+            raise ValueError(f"Unexpected strip of {rows}x{width} indices after {self.rows_written} rows of a {self.width}x{self.height} image")
+        self.file.write(pack_indices(indices).tobytes())
+        self.rows_written += rows
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"{self.rows_written} rows written out of {self.height}")
+        self.file.write(raw_palette_block(self.palette))
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
         else:
-            return None
+            self.close()
+
+def parse_raw_layout(buffer):
+    # Locate the blocks of a SAFB file held in a bytes-like buffer
+    # returns (width, height, data offset, palette) or None if this is not a valid SAFB file
+    if len(buffer) < 14 or buffer[0:4] != b"SAFB":
+        return None
+    width, height, palette_size = struct.unpack_from(">HHH", buffer, 4)
+
+    # check if the bitmap data block follows
+    if buffer[10:14] != b"DATA":
+        return None
+    data_offset = 14
+    palette_offset = data_offset + raw_row_bytes(width) * height
+
+    # check if the palette data block follows
+    if buffer[palette_offset:palette_offset + 4] != b"PAL4" or len(buffer) < palette_offset + 4 + palette_size * 2:
+        return None
 
     # process the palette data block
-    palette = []
-    for i in range(0, len(palette_data), 2):
-        rgb444 = int.from_bytes(palette_data[i:i+2], byteorder="big")
-        r = ((rgb444 >> 8) & 0xF) << 4
-        g = ((rgb444 >> 4) & 0xF) << 4
-        b = (rgb444 & 0xF) << 4
-        palette.append((r, g, b))
-
-    # create a blank PIL bitmap & palette
-    image = Image.new("P", (width, height))
-    palette_flat = [value for color in palette for value in color]
-    image.putpalette(palette_flat)
+    rgb444 = np.frombuffer(buffer, dtype=">u2", count=palette_size, offset=palette_offset + 4).astype(np.int32)
+    palette = np.stack([((rgb444 >> 8) & 0xF) << 4, ((rgb444 >> 4) & 0xF) << 4, (rgb444 & 0xF) << 4], axis=1)
+
+    return width, height, data_offset, [tuple(color) for color in palette.tolist()]
+
+
+def unpack_indices(color_data, width, height):
+    # (h, raw_row_bytes(w)) bytes -> (h, w) palette indices
+    packed = color_data.reshape(height, raw_row_bytes(width))
+    indices = np.empty((height, packed.shape[1] * 2), dtype=np.uint8)
+    np.right_shift(packed, 4, out=indices[:, 0::2])
+    np.bitwise_and(packed, 0xF, out=indices[:, 1::2])
+    return indices[:, :width]
+
+
+def map_raw_file(filename):
+    with open(filename, "rb") as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None
 
-    pixels = list(image.getdata())
 
-    # process the bitmap data block (recreate the image)
-    for i in range(0, len(color_data)):
-        byte = color_data[i]
-        even_index = (byte >> 4) & 0xF
-        odd_index = byte & 0xF
-        pixels[i * 2] = even_index
-        pixels[i * 2 + 1] = odd_index
-        # pixels[i * 2] = odd_index
-        # pixels[i * 2 + 1] = even_index
+def read_raw_header(filename):
+    # Header and palette only, the bitmap data is not read
+    # returns (width, height, palette) or None
+    mapped = map_raw_file(filename)
+    if mapped is None:
+        return None
+    with mapped:
+        layout = parse_raw_layout(mapped)
+    if layout is None:
+        return None
+    width, height, _, palette = layout
+    return width, height, palette
+
+
+def load_raw_indices(filename):
+    # returns ((h, w) array of palette indices, palette) or None
+    mapped = map_raw_file(filename)
+    if mapped is None:
+        return None
+    with mapped:
+        layout = parse_raw_layout(mapped)
+        if layout is None:
+            return None
+        width, height, data_offset, palette = layout
+        color_data = np.frombuffer(mapped, dtype=np.uint8, count=raw_row_bytes(width) * height, offset=data_offset)
+        indices = unpack_indices(color_data, width, height)
+        # release the view on the mapping before it gets closed
+        del color_data
+    return indices, palette
+
 
-    image.putdata(pixels)
+def load_raw_image(filename):
+    loaded = load_raw_indices(filename)
+    if loaded is None:
+        return None
+    indices, palette = loaded
+    height, width = indices.shape
+
+    # create the PIL bitmap & palette on top of the indices
+    image = Image.frombuffer("P", (width, height), np.ascontiguousarray(indices), "raw", "P", 0, 1)
+    palette_flat = [value for color in palette for value in color]
+    image.putpalette(palette_flat)
     return image
 
 # GFA Basic routine (untested)
@@ -0,0 +1,68 @@
+import numpy as np
+
+from quantize import pack_colors, unpack_colors, accumulate_key_counts
+from dither import overlay_in_place
+from mapping import palette_to_array, rows_per_block, palette_indices
+
+# Rows processed at a time: the working memory depends on the strip height
+# and on the image width, not on the image height
+DEFAULT_STRIP_HEIGHT = 256
+
+
+def image_size(source):
+    # (width, height) of a PIL image, or of a (h, w, 3) array
+    if isinstance(source, np.ndarray):
+        return source.shape[1], source.shape[0]
+    return source.size
+
+
+def image_strips(source, strip_height=DEFAULT_STRIP_HEIGHT):
+    # Yield (y0, (rows, w, 3) uint8 strip) from top to bottom.
+    # source is a PIL image, or a (h, w, 3) uint8 array such as a np.memmap
+    # whose rows are only read when their strip comes.
+    width, height = image_size(source)
+    for y0 in range(0, height, strip_height):
+        y1 = min(y0 + strip_height, height)
+        if isinstance(source, np.ndarray):
+            yield y0, np.asarray(source[y0:y1], dtype=np.uint8)
+        else:
+            yield y0, np.asarray(source.crop((0, y0, width, y1)).convert("RGB"))
+
+
+def strip_color_histogram(strips):
+    # Same result as quantize.build_color_histogram_from_image, one strip at a time
+    def strip_histograms():
+        for _, strip in strips:
+            keys, counts = np.unique(pack_colors(strip), return_counts=True)
+            yield keys, counts
+
+    merged = accumulate_key_counts(strip_histograms())
+    if merged is None:
+        return np.empty((0, 3), dtype=np.int32), np.empty(0, dtype=np.int64)
+    keys, counts = merged
+
+    print("True Color Palette: " + str(len(keys)) + " colors found.")
+    return unpack_colors(keys), counts
+
+
+def dithered_strips(strips, luma_amplitude=0.05, pattern="Checkerboard"):
+    # Same result as quantize.apply_dither_overlay, the pattern lines up across strips
+    for y0, strip in strips:
+        strip_data = strip.astype(np.float32)
+        strip_data /= 255
+        overlay_in_place(strip_data, luma_amplitude, pattern, 0, y0)
+        strip_data *= 255
+        yield y0, strip_data.astype(np.uint8)
+
+
+def indexed_strips(strips, palette, lookup="exact", bits_per_gun=4, color_space="RGB"):
+    # Same result as quantize.png_24bit_to_indexed, yields (y0, (rows, w) uint8 indices)
+    palette = palette_to_array(palette)
+    for y0, strip in strips:
+        height, width, _ = strip.shape
+        block_height = rows_per_block(width, len(palette) if lookup == "exact" else 1)
+        indices = np.empty((height, width), dtype=np.uint8)
+        for y in range(0, height, block_height):
+            block = strip[y:y + block_height].reshape(-1, 3)
+            indices[y:y + block_height] = palette_indices(block, palette, lookup, bits_per_gun, color_space).reshape(-1, width)
+        yield y0, indices